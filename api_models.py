@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 
 # Define request/response models
@@ -9,8 +9,22 @@ class StringRequest(BaseModel):
 class SourceDoc(BaseModel):
     source: str
     snippet: str
+    # Все страницы, на которых встречается текст фрагмента (см. dedup.py)
+    sources: List[str] = []
 
 class StringResponse(BaseModel):
     answer: str
     source_documents: List[SourceDoc]
-    session_id: str
\ No newline at end of file
+    session_id: str
+
+class BatchRequest(BaseModel):
+    requests: List[StringRequest]
+
+class BatchItem(BaseModel):
+    answer: Optional[str] = None
+    source_documents: List[SourceDoc] = []
+    session_id: str
+    error: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    results: List[BatchItem]
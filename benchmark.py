@@ -0,0 +1,393 @@
+"""
+Нагрузочное тестирование RAG-сервиса.
+
+Вопросы из JSONL-файла (по одному объекту {"question": str, "session": str} на строку,
+поле "session" необязательно - вопросы с одинаковым "session" задаются в рамках одного
+диалога) отправляются в сервис с заданной конкурентностью, после чего выводятся
+задержки (p50/p95/p99), пропускная способность и время работы узлов графа.
+
+Режимы работы:
+    python benchmark.py run [--url URL] ... - без --url запросы отправляются в main.app
+        внутри процесса, LLM, эмбеддинги и векторная БД при этом заменяются детерминированными
+        заглушками, т.е. тест работает без Ollama и OpenRouter. С --url запросы отправляются
+        по HTTP в уже запущенный сервис.
+    python benchmark.py serve [--port PORT] ... - запуск main.app с заглушками под uvicorn,
+        чтобы измерять работу сервиса по HTTP без внешних зависимостей.
+"""
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+DEFAULT_WORKLOAD = "benchmark_questions.jsonl"
+DEFAULT_DOCUMENTS = "prepared_documents_concat.json"
+# Узлы графа, совпадают с model.GRAPH_NODES (model здесь не импортируется до подмены зависимостей заглушками)
+GRAPH_NODES = ("trim_history", "generate_query_or_respond", "retrieve", "generate_answer")
+
+class FakeChatModel(BaseChatModel):
+    """
+    Детерминированная заглушка LLM. Если модели переданы тулы и последнее сообщение -
+    вопрос пользователя со словом из retrieval_keywords, вызывает первый тул с вопросом
+    в качестве запроса, иначе отвечает текстом, зависящим только от входных сообщений.
+    Время ответа имитируется задержкой latency секунд (с разбросом jitter).
+    """
+    latency: float = 0.0
+    jitter: float = 0.0
+    retrieval_keywords: List[str] = ["неофлекс", "neoflex", "компан", "проект"]
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=tools, **kwargs)
+
+    def delay(self, messages):
+        rng = random.Random(str(messages[-1].content))
+        return max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter))
+
+    def respond(self, messages, tools=None):
+        last = messages[-1]
+        content = last.content if isinstance(last.content, str) else str(last.content)
+        if tools and type(last) is HumanMessage and any(w in content.lower() for w in self.retrieval_keywords):
+            tool = tools[0]
+            name = tool["function"]["name"] if isinstance(tool, dict) else tool.name
+            message = AIMessage(
+                content="",
+                tool_calls=[{"name": name, "args": {"query": content}, "id": f"call_{uuid.uuid4().hex[:8]}"}],
+            )
+        else:
+            words = content.split()
+            message = AIMessage(content=f"Ответ ({len(words)} слов во входных данных): " + " ".join(words[-20:]))
+        input_tokens = sum(len(str(m.content).split()) for m in messages)
+        output_tokens = len(str(message.content).split())
+        message.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, tools=None, **kwargs):
+        time.sleep(self.delay(messages))
+        return self.respond(messages, tools)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, tools=None, **kwargs):
+        await asyncio.sleep(self.delay(messages))
+        return self.respond(messages, tools)
+
+class NodeTimer(BaseCallbackHandler):
+    """
+    Сбор времени работы узлов графа через callback'и LangChain
+    """
+    def __init__(self):
+        self.runs = {}
+        self.durations = {node: [] for node in GRAPH_NODES}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        name = kwargs.get("name")
+        if name not in self.durations:
+            return
+        # Узел и обёрнутая в него функция называются одинаково, учитывается только внешний запуск
+        parent = self.runs.get(parent_run_id)
+        if parent is not None and parent[0] == name:
+            return
+        self.runs[run_id] = (name, time.perf_counter())
+
+    def finish(self, run_id):
+        run = self.runs.pop(run_id, None)
+        if run is not None:
+            self.durations[run[0]].append(time.perf_counter() - run[1])
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self.finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.finish(run_id)
+
+class TimedGraph:
+    """
+    Обёртка над скомпилированным графом, добавляющая NodeTimer в callback'и
+    каждого запуска. Остальные атрибуты берутся из исходного графа.
+    """
+    def __init__(self, graph, timer: NodeTimer):
+        self.graph = graph
+        self.timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self.graph, name)
+
+    def with_timer(self, config):
+        config = dict(config or {})
+        config["callbacks"] = list(config.get("callbacks") or []) + [self.timer]
+        return config
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.graph.invoke(input, self.with_timer(config), **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await self.graph.ainvoke(input, self.with_timer(config), **kwargs)
+
+    def astream(self, input, config=None, **kwargs):
+        return self.graph.astream(input, self.with_timer(config), **kwargs)
+
+def build_fake_vector_store(embeddings, documents_file: str, limit: int, persist_directory: str):
+    """
+    Векторная БД в папке persist_directory, заполненная первыми limit записями
+    documents_file с эмбеддингами-заглушками, её лексический индекс и индекс разделов
+    """
+    from langchain_chroma import Chroma
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from document_loader import iter_records
+    from lexical_index import build_lexical_index, lexical_index_path
+    from section_index import build_section_index, iter_section_vectors, section_index_path
+
+    records = []
+    for obj in iter_records(documents_file):
+        if len(records) >= limit:
+            break
+        records.append(obj)
+    splitter = RecursiveCharacterTextSplitter(
+        separators=["\n\n", ".", " "],
+        chunk_size=1000,
+        chunk_overlap=100,
+    )
+    documents = splitter.create_documents(
+        [obj["text"] for obj in records],
+        metadatas=[{"source": obj["url"], "section": obj["section"]} for obj in records],
+    )
+    vector_db = Chroma(
+        collection_name="benchmark_collection",
+        embedding_function=embeddings,
+        persist_directory=persist_directory,
+    )
+    ids = vector_db.add_documents(documents)
+    build_lexical_index(
+        zip(ids, [d.page_content for d in documents]),
+        lexical_index_path(persist_directory, "benchmark_collection"),
+    )
+    build_section_index(
+        iter_section_vectors(vector_db),
+        section_index_path(persist_directory, "benchmark_collection"),
+    )
+    return vector_db
+
+def install_fakes(args):
+    """
+    Подмена LLM, эмбеддингов и векторной БД заглушками и импорт main.app.
+    Должна вызываться до первого импорта main.
+
+    Выходные данные:
+        Пара (main.app, NodeTimer)
+    """
+    import config
+    import llms
+    import vector_store
+    import lexical_index
+    import section_index
+
+    fake_embeddings = DeterministicFakeEmbedding(size=args.embedding_size)
+    fake_llm = FakeChatModel(latency=args.llm_latency, jitter=args.llm_jitter)
+    config.embeddings = fake_embeddings
+    llms.create_llm = lambda *a, **kw: fake_llm
+    db_path = tempfile.mkdtemp(prefix="nf_hw_benchmark_")
+    vector_store.load_vector_store = lambda collection_name, embeddings, backend="chroma": build_fake_vector_store(
+        embeddings, args.documents, args.documents_limit, db_path
+    )
+    lexical_index.load_lexical_index = lambda path, collection_name: lexical_index.LexicalIndex(
+        lexical_index.lexical_index_path(db_path, "benchmark_collection")
+    )
+    section_index.load_section_index = lambda path, collection_name, embeddings: section_index.SectionIndex(
+        section_index.section_index_path(db_path, "benchmark_collection"), embeddings
+    )
+
+    import main
+    from state import model_data
+
+    timer = NodeTimer()
+    model_data.graph = TimedGraph(model_data.graph, timer)
+    return main.app, timer
+
+def load_workload(filename: str, repeat: int):
+    """
+    Чтение вопросов из JSONL-файла. Каждому значению поля "session" (а вопросам
+    без него - каждому своё) сопоставляется новый session_id.
+    """
+    with open(filename, 'r', encoding='utf-8') as file:
+        items = [json.loads(line) for line in file if line.strip()]
+    workload = []
+    for _ in range(repeat):
+        sessions = {}
+        for item in items:
+            label = item.get("session")
+            if label is None:
+                session_id = str(uuid.uuid4())
+            else:
+                session_id = sessions.setdefault(label, str(uuid.uuid4()))
+            workload.append({"session_id": session_id, "question": item["question"]})
+    return workload
+
+async def send_request(client, item: dict, stream: bool):
+    """
+    Отправка одного запроса
+
+    Выходные данные:
+        Словарь {"latency": float, "ttft": Optional[float], "error": Optional[str]}
+    """
+    start = time.perf_counter()
+    ttft = None
+    try:
+        if not stream:
+            response = await client.post("/process-string", json=item)
+            response.raise_for_status()
+        else:
+            async with client.stream("POST", "/process-string-stream", json=item) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    if ttft is None and event["type"] in ("token", "done"):
+                        ttft = time.perf_counter() - start
+                    if event["type"] == "error":
+                        raise RuntimeError(event.get("detail"))
+        return {"latency": time.perf_counter() - start, "ttft": ttft, "error": None}
+    except Exception as e:
+        return {"latency": time.perf_counter() - start, "ttft": ttft, "error": f"{type(e).__name__}: {e}"}
+
+async def run_workload(client, workload: List[dict], concurrency: int, stream: bool):
+    """
+    Отправка всех запросов workload не более чем concurrency штук одновременно.
+    Вопросы одного диалога отправляются последовательно, в порядке файла.
+    """
+    sessions: Dict[str, List[dict]] = {}
+    for item in workload:
+        sessions.setdefault(item["session_id"], []).append(item)
+    queue = asyncio.Queue()
+    for items in sessions.values():
+        queue.put_nowait(items)
+    results = []
+
+    async def worker():
+        while not queue.empty():
+            for item in queue.get_nowait():
+                results.append(await send_request(client, item, stream))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results, time.perf_counter() - start
+
+def summarize(values: List[float]):
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    return {
+        "count": int(len(values)),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+    }
+
+def make_report(results: List[dict], elapsed: float, timer: Optional[NodeTimer]):
+    ok = [r for r in results if r["error"] is None]
+    report = {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "elapsed_s": elapsed,
+        "requests_per_s": len(ok) / elapsed if elapsed > 0 else 0.0,
+        "latency": summarize([r["latency"] for r in ok]),
+        "time_to_first_token": summarize([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "error_samples": sorted({r["error"] for r in results if r["error"] is not None})[:5],
+    }
+    if timer is not None:
+        report["nodes"] = {node: summarize(durations) for node, durations in timer.durations.items()}
+    return report
+
+def print_report(report: Dict[str, Any]):
+    print(f"Requests: {report['requests']}, errors: {report['errors']}, "
+          f"elapsed: {report['elapsed_s']:.2f} s, throughput: {report['requests_per_s']:.2f} req/s")
+    rows = [("request latency", report["latency"]), ("time to first token", report["time_to_first_token"])]
+    rows += [(f"node {node}", stats) for node, stats in report.get("nodes", {}).items()]
+    print(f"{'':32}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+    for name, stats in rows:
+        if stats is None:
+            continue
+        print(f"{name:32}{stats['count']:>8}{stats['mean_ms']:>10.1f}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    for error in report["error_samples"]:
+        print(f"error: {error}")
+
+async def run(args):
+    import httpx
+
+    workload = load_workload(args.workload, args.repeat)
+    timer = None
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits)
+    else:
+        app, timer = install_fakes(args)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=timeout)
+    async with client:
+        if args.warmup:
+            await run_workload(client, load_workload(args.workload, 1)[:args.warmup], args.concurrency, args.stream)
+            if timer is not None:
+                timer.durations = {node: [] for node in GRAPH_NODES}
+        results, elapsed = await run_workload(client, workload, args.concurrency, args.stream)
+    report = make_report(results, elapsed, timer)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+def add_fake_arguments(parser):
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="имитируемое время ответа LLM-заглушки, с")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="разброс времени ответа LLM-заглушки, с")
+    parser.add_argument("--embedding-size", type=int, default=256, help="размерность эмбеддингов-заглушек")
+    parser.add_argument("--documents", default=DEFAULT_DOCUMENTS, help="документы для векторной БД-заглушки")
+    parser.add_argument("--documents-limit", type=int, default=100, help="число документов в векторной БД-заглушке")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование RAG-сервиса")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="прогнать набор вопросов и вывести статистику")
+    run_parser.add_argument("--url", help="адрес запущенного сервиса; без него main.app с заглушками запускается в процессе")
+    run_parser.add_argument("--workload", default=DEFAULT_WORKLOAD, help="JSONL-файл с вопросами")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="число одновременных запросов")
+    run_parser.add_argument("--repeat", type=int, default=1, help="сколько раз повторить набор вопросов")
+    run_parser.add_argument("--warmup", type=int, default=0, help="число вопросов для прогрева, не входящих в статистику")
+    run_parser.add_argument("--stream", action="store_true", help="использовать /process-string-stream и измерять время до первого токена")
+    run_parser.add_argument("--timeout", type=float, default=600, help="таймаут одного запроса, с")
+    run_parser.add_argument("--json", help="файл для сохранения отчёта в формате JSON")
+    add_fake_arguments(run_parser)
+
+    serve_parser = commands.add_parser("serve", help="запустить main.app с заглушками под uvicorn")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8001)
+    add_fake_arguments(serve_parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.command == "serve":
+        import uvicorn
+        app, _ = install_fakes(args)
+        uvicorn.run(app, host=args.host, port=args.port)
+    else:
+        asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from metrics import EMBEDDING_DURATION
+
+def normalize_query(text: str):
+    """
+    Нормализация текста запроса для использования в качестве ключа кэша:
+    нижний регистр, без крайних пробелов, последовательности пробельных
+    символов заменены одним пробелом.
+    """
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кэш с необязательным временем жизни записей (ttl, в секундах)
+    и счётчиками попаданий (hits) и промахов (misses). Если задан version_getter,
+    кэш очищается при каждой смене возвращаемой им версии данных
+    (см. vector_store.get_collection_version).
+    """
+    def __init__(self, maxsize: int, ttl: Optional[float] = None,
+                 version_getter: Optional[Callable[[], str]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_getter = version_getter
+        self.version = version_getter() if version_getter is not None else None
+        self.d = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def check_version(self, version):
+        if version != self.version:
+            self.d.clear()
+            self.version = version
+
+    def get(self, key, default=None):
+        return self.get_many([key], default)[0]
+
+    def get_many(self, keys, default=None):
+        """
+        Чтение нескольких записей с одной проверкой версии данных
+
+        Выходные данные:
+            Список значений в порядке ключей (default для отсутствующих)
+        """
+        # Версия читается до захвата блокировки, чтобы не держать её на время обращения к файлу
+        version = self.version_getter() if self.version_getter is not None else None
+        values = []
+        with self.lock:
+            if self.version_getter is not None:
+                self.check_version(version)
+            for key in keys:
+                item = self.d.get(key)
+                if item is not None and self.ttl is not None and time.monotonic() - item[1] > self.ttl:
+                    del self.d[key]
+                    item = None
+                if item is None:
+                    self.misses += 1
+                    values.append(default)
+                    continue
+                self.d.move_to_end(key)
+                self.hits += 1
+                values.append(item[0])
+        return values
+
+    def put(self, key, value):
+        with self.lock:
+            self.d[key] = (value, time.monotonic())
+            self.d.move_to_end(key)
+            while len(self.d) > self.maxsize:
+                self.d.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.d)
+
+    def stats(self):
+        """
+        Статистика кэша: размер, число попаданий и промахов
+        """
+        with self.lock:
+            return {"size": len(self.d), "hits": self.hits, "misses": self.misses}
+
+class CachedEmbeddings(Embeddings):
+    """
+    Обёртка над эмбеддингами, кэширующая эмбеддинги запросов (embed_query)
+    по нормализованному тексту запроса: в памяти (LRU) и, если задан disk_path,
+    в SQLite-файле, сохраняющемся между перезапусками. Ключ кэша включает имя
+    модели, поэтому смена модели эмбеддингов не приводит к использованию старых
+    векторов. Эмбеддинги документов (embed_documents) не кэшируются.
+    """
+    def __init__(self, embeddings: Embeddings, model_name: str, maxsize: int = 10000,
+                 disk_path: Optional[str] = None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.memory = LRUCache(maxsize)
+        self.disk_hits = 0
+        self.conn = None
+        if disk_path:
+            self.conn = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self.disk_lock = threading.Lock()
+
+    def make_key(self, text: str):
+        return hashlib.sha256(f"{self.model_name}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str):
+        """
+        Поиск эмбеддинга запроса в кэше (сначала в памяти, затем на диске)
+
+        Выходные данные:
+            Эмбеддинг или None, если запроса нет в кэше
+        """
+        vector = self.memory.get(key)
+        if vector is not None or self.conn is None:
+            return vector
+        with self.disk_lock:
+            row = self.conn.execute("SELECT vector FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        vector = vector.tolist()
+        self.disk_hits += 1
+        self.memory.put(key, vector)
+        return vector
+
+    def store(self, key: str, vector: List[float]):
+        self.memory.put(key, vector)
+        if self.conn is not None:
+            with self.disk_lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (key, vector) VALUES (?, ?)",
+                    (key, array("f", vector).tobytes()),
+                )
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.make_key(text)
+        vector = self.lookup(key)
+        if vector is None:
+            with EMBEDDING_DURATION.time():
+                vector = self.embeddings.embed_query(text)
+            self.store(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self.make_key(text)
+        vector = self.lookup(key)
+        if vector is None:
+            with EMBEDDING_DURATION.time():
+                vector = await self.embeddings.aembed_query(text)
+            self.store(key, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Эмбеддинги нескольких запросов: отсутствующие в кэше считаются
+        одним вызовом embed_documents и сохраняются в кэш
+        """
+        keys = [self.make_key(text) for text in texts]
+        vectors = [self.lookup(key) for key in keys]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            with EMBEDDING_DURATION.time():
+                computed = dict(zip(missing, self.embeddings.embed_documents(missing)))
+            for i, text in enumerate(texts):
+                if vectors[i] is None:
+                    vectors[i] = computed[text]
+                    self.store(keys[i], vectors[i])
+        return vectors
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Асинхронный вариант embed_queries
+        """
+        keys = [self.make_key(text) for text in texts]
+        vectors = [self.lookup(key) for key in keys]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            with EMBEDDING_DURATION.time():
+                computed = dict(zip(missing, await self.embeddings.aembed_documents(missing)))
+            for i, text in enumerate(texts):
+                if vectors[i] is None:
+                    vectors[i] = computed[text]
+                    self.store(keys[i], vectors[i])
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def stats(self):
+        """
+        Статистика кэша эмбеддингов запросов
+        """
+        stats = self.memory.stats()
+        stats["disk_hits"] = self.disk_hits
+        return stats
+
+class SemanticAnswerCache:
+    """
+    Кэш ответов на вопросы, заданные без контекста (первым сообщением диалога).
+    Вопрос считается уже встречавшимся, если косинусная близость его эмбеддинга
+    к эмбеддингу сохранённого вопроса не меньше threshold. Хранится не более
+    maxsize ответов, при переполнении заменяются самые старые. Кэш очищается
+    при смене версии коллекции (version_getter), т.е. при пересоздании БД.
+    """
+    def __init__(self, embeddings: Embeddings, threshold: float, maxsize: int = 1000,
+                 version_getter: Optional[Callable[[], str]] = None):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.version_getter = version_getter
+        self.version = version_getter() if version_getter is not None else None
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.answers = [None] * maxsize
+        self.count = 0
+        self.next_slot = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.reset()
+
+    def reset(self):
+        self.vectors = None
+        self.answers = [None] * self.maxsize
+        self.count = 0
+        self.next_slot = 0
+
+    @staticmethod
+    def normalize(vector: List[float]):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def find(self, vector: List[float]):
+        """
+        Поиск ответа по эмбеддингу вопроса
+
+        Выходные данные:
+            Словарь {"answer": str, "source_documents": List[dict]} или None
+        """
+        version = self.version_getter() if self.version_getter is not None else None
+        query = self.normalize(vector)
+        with self.lock:
+            if version != self.version:
+                self.reset()
+                self.version = version
+            if self.count == 0 or self.vectors.shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+            similarities = self.vectors[:self.count] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            answer, source_documents = self.answers[best]
+        return {"answer": answer, "source_documents": [dict(d) for d in source_documents]}
+
+    def add(self, vector: List[float], answer: str, source_documents: List[dict]):
+        """
+        Сохранение ответа на вопрос с эмбеддингом vector
+        """
+        vector = self.normalize(vector)
+        with self.lock:
+            if self.vectors is None or self.vectors.shape[1] != vector.shape[0]:
+                self.vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+                self.count = 0
+                self.next_slot = 0
+            self.vectors[self.next_slot] = vector
+            self.answers[self.next_slot] = (answer, [dict(d) for d in source_documents])
+            self.next_slot = (self.next_slot + 1) % self.maxsize
+            self.count = min(self.count + 1, self.maxsize)
+
+    def lookup(self, question: str):
+        return self.find(self.embeddings.embed_query(question))
+
+    async def alookup(self, question: str):
+        return self.find(await self.embeddings.aembed_query(question))
+
+    def store(self, question: str, answer: str, source_documents: List[dict]):
+        self.add(self.embeddings.embed_query(question), answer, source_documents)
+
+    async def astore(self, question: str, answer: str, source_documents: List[dict]):
+        self.add(await self.embeddings.aembed_query(question), answer, source_documents)
+
+    def stats(self):
+        """
+        Статистика кэша ответов
+        """
+        with self.lock:
+            return {"size": self.count, "hits": self.hits, "misses": self.misses}
+
+def make_retrieval_key(query: str, k: int, filter: Optional[Any] = None, **kwargs):
+    """
+    Ключ кэша результатов поиска по векторной БД: нормализованный запрос,
+    число документов, фильтр и прочие параметры поиска
+    """
+    return (
+        normalize_query(query),
+        k,
+        json.dumps(filter, sort_keys=True, ensure_ascii=False, default=str),
+        json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str),
+    )
@@ -6,8 +6,131 @@ from langchain_ollama import OllamaEmbeddings
 USE_LOCAL_MODEL = True
 USED_MODEL = "GPT-4o"
 
+# Пул LLM: список моделей в порядке приоритета (имена из llms.model_data и "local" -
+# локальная модель). Если задан, USE_LOCAL_MODEL и USED_MODEL не используются:
+# запросы распределяются между моделями пула с переходом на следующую при ошибках
+LLM_POOL = None
+# Максимальное число одновременных запросов к одной модели пула
+# (если для неё не задано "concurrency" в llms.model_data)
+LLM_POOL_MAX_CONCURRENCY = 8
+# Время в секундах, после которого запрос без ответа дублируется другой модели пула, None - не дублировать
+LLM_HEDGE_AFTER = None
+
 COLLECTION_NAME = "nf_hw_collection"
+# Векторная БД: "chroma" - коллекция Chroma, "numpy" - её выгрузка в NumPy-матрицу
+# в памяти процесса (быстрее для небольших коллекций, создаётся db_creator.py)
+VECTOR_STORE_BACKEND = "chroma"
+
+# Максимальное число запросов, одновременно обрабатываемых графом
+MAX_CONCURRENT_REQUESTS = 32
+# Максимальное время обработки одного запроса, в секундах
+REQUEST_TIMEOUT = 300
+# Пакетная обработка вопросов (/process-batch): максимальное число вопросов в пакете,
+# число одновременных запусков графа внутри пакета и время обработки всего пакета, в секундах
+BATCH_MAX_SIZE = 100
+BATCH_MAX_CONCURRENCY = 8
+BATCH_TIMEOUT = 1800
+
+# Хранилище сеансов и истории диалогов: "memory" - в памяти процесса,
+# "sqlite" - в файле SESSION_DB_PATH, общем для всех uvicorn-воркеров
+SESSION_BACKEND = "memory"
+SESSION_DB_PATH = "./sessions.sqlite"
+# Максимальное число хранимых сеансов (самые давние удаляются), None - без ограничения
+MAX_SESSIONS = 10000
+# Время жизни неиспользуемого сеанса в секундах, None - без ограничения
+SESSION_TTL = 7 * 24 * 60 * 60
+# Максимальное число сообщений, хранимых в истории одного диалога, None - без ограничения
+MAX_MESSAGES_PER_THREAD = 40
+# Число последних ходов диалога (вопрос пользователя и ответ на него), сохраняемых дословно,
+# None - без ограничения. Из прошлых ходов удаляются найденные тулом документы
+HISTORY_WINDOW_TURNS = 6
+# Более старые ходы заменяются кратким содержанием, которое LLM обновляет раз
+# в HISTORY_SUMMARY_BATCH ходов. Если выключено, старые ходы просто удаляются
+HISTORY_SUMMARY_ENABLED = True
+HISTORY_SUMMARY_BATCH = 4
+
+EMBEDDING_MODEL = "qwen3-embedding"
+# Объединение одновременных запросов к модели эмбеддингов в пачки: запросы, поступившие
+# в течение EMBEDDING_BATCH_WAIT секунд, отправляются одним вызовом (не больше
+# EMBEDDING_BATCH_SIZE текстов), пачки обрабатываются в EMBEDDING_BATCH_WORKERS потоков
+EMBEDDING_BATCHING = True
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_BATCH_WAIT = 0.005
+EMBEDDING_BATCH_WORKERS = 2
+# Размер кэша эмбеддингов запросов в памяти
+EMBEDDING_CACHE_SIZE = 10000
+# SQLite-файл для хранения кэша эмбеддингов запросов на диске, None - только в памяти
+EMBEDDING_CACHE_PATH = None
+# Размер и время жизни (в секундах) кэша результатов поиска по векторной БД
+RETRIEVAL_CACHE_SIZE = 1000
+RETRIEVAL_CACHE_TTL = 60 * 60
+# Кэш ответов на вопросы без контекста (первые сообщения диалога):
+# похожим считается вопрос с косинусной близостью эмбеддингов не меньше порога
+ANSWER_CACHE_ENABLED = False
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_SIZE = 1000
+
+# Гибридный поиск: результаты векторного поиска объединяются с результатами
+# лексического (BM25) индекса, построенного db_creator.py. Если индекса нет,
+# используется только векторный поиск
+HYBRID_RETRIEVAL = True
+# Число кандидатов, отбираемых каждым из способов поиска перед объединением
+HYBRID_CANDIDATES = 20
+# Двухэтапный поиск: сначала по индексу разделов, построенному db_creator.py, отбирается
+# SECTION_CANDIDATES разделов (поле метаданных "section"), ближайших к запросу, затем фрагменты
+# ищутся только среди фрагментов этих разделов (результаты лексического индекса не фильтруются).
+# Если индекса нет или в среднем на раздел приходится меньше SECTION_MIN_CHUNKS фрагментов
+# (разделы почти совпадают с фрагментами, отбор разделов не сокращает поиск), ищется по всей коллекции.
+# Выключен по умолчанию: в текущей коллекции раздел - это, по сути, отдельная страница
+SECTION_ROUTING = False
+SECTION_CANDIDATES = 10
+SECTION_MIN_CHUNKS = 3
+# Переранжирование найденных фрагментов: отбирается RERANK_CANDIDATES кандидатов,
+# в промпт передаются RERANK_TOP_K лучших из них. Способ оценки: "embeddings" -
+# косинусная близость к сохранённым в БД эмбеддингам фрагментов, "cross-encoder" -
+# модель CROSS_ENCODER_MODEL на CPU (требует пакета sentence-transformers)
+RERANK_ENABLED = False
+RERANK_BACKEND = "embeddings"
+RERANK_CANDIDATES = 20
+RERANK_TOP_K = 3
+CROSS_ENCODER_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+# Маршрутизация вопросов без обращения к LLM: вопросы с ключевыми словами ROUTER_KEYWORDS
+# или с косинусной близостью к ближайшему фрагменту БД не меньше ROUTER_RETRIEVE_THRESHOLD
+# сразу отправляются на поиск, а похожие на светскую беседу (близость к примерам не меньше
+# ROUTER_RESPOND_THRESHOLD) - сразу на ответ. Применяется только к первому вопросу диалога.
+# Пороги зависят от модели эмбеддингов и пока не подобраны: перед включением их нужно
+# откалибровать по распределению близостей для размеченных вопросов (рабочих и светской беседы)
+ROUTER_ENABLED = False
+ROUTER_KEYWORDS = ("неофлекс", "neoflex")
+ROUTER_RETRIEVE_THRESHOLD = 0.6
+ROUTER_RESPOND_THRESHOLD = 0.8
+
+# Максимальный размер контекста из найденных фрагментов в промпте generate_answer,
+# в токенах (оценивается как число символов / CONTEXT_CHARS_PER_TOKEN), None - без ограничения
+CONTEXT_TOKEN_BUDGET = 1500
+CONTEXT_CHARS_PER_TOKEN = 3.0
+# Фрагмент не попадает в контекст, если такая доля его текста уже есть в других фрагментах
+CONTEXT_DUPLICATE_THRESHOLD = 0.8
+
+# Создание LLM, векторной БД и зависящих от неё компонентов в фоне сразу после запуска сервера.
+# Если выключено, они создаются при первом запросе. Готовность сообщает endpoint /ready
+INIT_ON_STARTUP = True
+
+# Время в секундах, в течение которого локальные модели Ollama (LLM и эмбеддинги) остаются
+# загруженными после последнего запроса, -1 - не выгружать, None - значение сервера Ollama (5 минут)
+OLLAMA_KEEP_ALIVE = 1800
+# Прогрев локальных моделей коротким запросом после запуска сервера и затем каждые
+# WARMUP_INTERVAL секунд (None - только после запуска), чтобы первый запрос пользователя
+# не ждал загрузки модели, а общий префикс промптов уже был в кэше сервера модели
+WARMUP_ENABLED = True
+WARMUP_INTERVAL = 600
+
+LOG_LEVEL = "INFO"
+# Доля запросов к LLM, текст которых (промпт и ответ) пишется в лог, от 0 до 1
+LOG_PROMPTS_SAMPLE_RATE = 0.0
 
 embeddings = OllamaEmbeddings(
-    model="qwen3-embedding",
+    model=EMBEDDING_MODEL,
+    keep_alive=OLLAMA_KEEP_ALIVE,
 )
\ No newline at end of file
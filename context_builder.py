@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from typing import List, Optional
+from langchain_core.documents import Document
+from lexical_index import tokenize
+
+def shingles(text: str, size: int = 3):
+    """
+    Множество последовательностей из size подряд идущих термов текста
+    """
+    tokens = tokenize(text)
+    if len(tokens) <= size:
+        return {tuple(tokens)}
+    return {tuple(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+def merge_overlapping(first: str, second: str, min_overlap: int = 20):
+    """
+    Склейка двух фрагментов одного документа, если конец first совпадает
+    с началом second (перекрытие, добавляемое text splitter'ом) или один
+    фрагмент целиком содержится в другом
+
+    Выходные данные:
+        Склеенный текст, либо None, если фрагменты не перекрываются
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    head = second[:min_overlap]
+    if len(head) < min_overlap:
+        return None
+    pos = first.find(head)
+    while pos != -1:
+        if second.startswith(first[pos:]):
+            return first + second[len(first) - pos:]
+        pos = first.find(head, pos + 1)
+    return None
+
+def truncate_text(text: str, max_chars: int):
+    """
+    Обрезка текста до max_chars символов по границе предложения или слова
+    """
+    if len(text) <= max_chars:
+        return text
+    text = text[:max_chars]
+    cut = text.rfind(". ")
+    if cut < max_chars // 2:
+        cut = text.rfind(" ")
+    return text[:cut + 1].rstrip() if cut > 0 else text
+
+def assemble_context(documents: List[Document], token_budget: Optional[int] = None,
+                     chars_per_token: float = 3.0, duplicate_threshold: float = 0.8):
+    """
+    Сборка контекста для промпта из найденных фрагментов:
+    - почти дублирующие фрагменты (доля общих последовательностей термов
+      не меньше duplicate_threshold) отбрасываются;
+    - перекрывающиеся фрагменты одного источника склеиваются, а все фрагменты
+      одного источника объединяются в один блок с указанием источника;
+    - блоки добавляются в порядке релевантности (по лучшему фрагменту источника),
+      пока оценка числа токенов не превысит token_budget; блок, не поместившийся
+      целиком, обрезается.
+
+    Входные данные:
+        documents - найденные фрагменты в порядке убывания релевантности
+        token_budget - максимальный размер контекста в токенах, None - без ограничения
+        chars_per_token - среднее число символов текста на один токен, для оценки размера
+        duplicate_threshold - порог отбрасывания почти дублирующих фрагментов
+
+    Выходные данные:
+        Строка контекста
+    """
+    kept = []
+    for doc in documents:
+        doc_shingles = shingles(doc.page_content)
+        if any(len(doc_shingles & other) >= duplicate_threshold * len(doc_shingles) for _, other in kept):
+            continue
+        kept.append((doc, doc_shingles))
+
+    groups = OrderedDict()
+    for doc, _ in kept:
+        parts = groups.setdefault(doc.metadata.get("source"), [])
+        text = doc.page_content.strip()
+        for i, part in enumerate(parts):
+            merged = merge_overlapping(part, text) or merge_overlapping(text, part)
+            if merged is not None:
+                parts[i] = merged
+                break
+        else:
+            parts.append(text)
+
+    blocks = []
+    for source, parts in groups.items():
+        text = " ".join(parts)
+        blocks.append(f"Источник: {source}\n{text}" if source else text)
+
+    if token_budget is None:
+        return "\n\n".join(blocks)
+    max_chars = int(token_budget * chars_per_token)
+    packed = []
+    used = 0
+    for block in blocks:
+        remaining = max_chars - used - (2 if packed else 0)
+        if len(block) > remaining:
+            # Слишком короткий остаток блока не несёт смысла и не добавляется
+            if remaining >= 200:
+                packed.append(truncate_text(block, remaining))
+            break
+        packed.append(block)
+        used += len(block) + (2 if len(packed) > 1 else 0)
+    return "\n\n".join(packed)
@@ -1,47 +1,260 @@
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_ollama import OllamaEmbeddings
 from langchain_chroma import Chroma
-import json
-import sys
+from vector_store import bump_collection_version
+from lexical_index import build_lexical_index, lexical_index_path
+from numpy_store import export_numpy_index, numpy_index_path
+from section_index import build_section_index, iter_section_vectors, section_index_path
+from document_loader import iter_records, batched
+from embedding_broker import EmbeddingBroker
+from dedup import NearDuplicateFilter, drop_near_duplicates, join_sources
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import hashlib
+import os
+import time
 
-if len(sys.argv) != 4:
-    print("Usage: python db_creator.py [JSON file with data] [db path] [collection name]")
-    quit()
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Создание (или обновление) векторной БД из JSON-файла с документами",
+        usage="python db_creator.py [JSON file with data] [db path] [collection name] [options]",
+    )
+    parser.add_argument("docs_filename", help="JSON file with data (JSON array or JSONL)")
+    parser.add_argument("db_path", help="db path")
+    parser.add_argument("collection_name", help="collection name")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="не пересоздавать коллекцию: добавить только новые и изменённые фрагменты, удалить исчезнувшие",
+    )
+    parser.add_argument("--batch-size", type=int, default=64, help="число фрагментов в одном запросе к модели эмбеддингов")
+    parser.add_argument("--workers", type=int, default=4, help="число параллельных запросов к модели эмбеддингов")
+    parser.add_argument(
+        "--dedup-threshold", type=float, default=0.85,
+        help="порог оценки коэффициента Жаккара, начиная с которого фрагмент считается почти дубликатом",
+    )
+    parser.add_argument("--no-dedup", action="store_true", help="не отбрасывать почти дублирующие фрагменты")
+    return parser.parse_args()
 
-docs_filename = sys.argv[1]
-db_path = sys.argv[2]
-collection_name = sys.argv[3]
+def chunk_id(document):
+    """
+    ID фрагмента в БД - хэш его источника, раздела и текста.
+    Не меняется, пока не изменился сам фрагмент, что позволяет
+    при инкрементальном обновлении пропускать уже посчитанные фрагменты.
+    """
+    key = "\n".join([document.metadata["source"], document.metadata["section"], document.page_content])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
-print('Remember that embeddings in the db_creator and those in the main app should be the same!')
-print('Are you ready to proceed? (Y/y for positive answer, anything else for negative)')
+def get_existing_ids(vector_store, page_size=10000):
+    """
+    Получение ID всех фрагментов, уже сохранённых в коллекции (без текстов и эмбеддингов)
+    """
+    ids = set()
+    offset = 0
+    while True:
+        page = vector_store.get(include=[], limit=page_size, offset=offset)["ids"]
+        ids.update(page)
+        if len(page) < page_size:
+            return ids
+        offset += page_size
 
-if input().lower() != 'y':
-    quit()
+def iter_collection_texts(vector_store, page_size=10000):
+    """
+    Постраничное чтение ID и текстов всех фрагментов коллекции (без эмбеддингов)
 
-embeddings = OllamaEmbeddings(
-    model="qwen3-embedding",
-)
+    Выходные данные:
+        Генератор пар (ID фрагмента, текст фрагмента)
+    """
+    offset = 0
+    while True:
+        page = vector_store.get(include=["documents"], limit=page_size, offset=offset)
+        yield from zip(page["ids"], page["documents"])
+        if len(page["ids"]) < page_size:
+            return
+        offset += page_size
 
-vector_store = Chroma(
-    collection_name=collection_name,
-    embedding_function=embeddings,
-    persist_directory=db_path,  # Where to save data locally, remove if not necessary
-)
+def split_records(records, splitter):
+    """
+    Разбиение потока записей на фрагменты, по одной записи за раз
+    """
+    for obj in records:
+        yield from splitter.create_documents(
+            [obj["text"]],
+            metadatas=[{"source": obj["url"], "section": obj["section"]}],
+        )
 
-vector_store.reset_collection()
+def select_chunks(documents, existing_ids, current_ids):
+    """
+    Отбор фрагментов, которые нужно посчитать и записать в БД: пропускаются
+    фрагменты, уже сохранённые в коллекции (existing_ids), и повторы внутри
+    текущего прогона. ID всех встреченных фрагментов добавляются в current_ids.
 
-with open(docs_filename, 'r', encoding='utf-8') as file:
-    docs_from_file = json.load(file)
+    Выходные данные:
+        Генератор пар (фрагмент, ID фрагмента)
+    """
+    for document in documents:
+        doc_id = chunk_id(document)
+        if doc_id in current_ids:
+            continue
+        current_ids.add(doc_id)
+        if doc_id not in existing_ids:
+            yield document, doc_id
 
-splitter = RecursiveCharacterTextSplitter(
-    separators=["\n\n", ".", " "],
-    chunk_size=1000,
-    chunk_overlap=100,
-)
+def sync_sources(vector_store, merged_sources, page_size=10000):
+    """
+    Запись в метаданные фрагментов (поле "sources") источников их отброшенных
+    почти дубликатов. У фрагментов, дубликаты которых исчезли, поле удаляется.
+    Эмбеддинги при этом не пересчитываются.
 
-documents = splitter.create_documents(
-    [obj["text"] for obj in docs_from_file],
-    metadatas=[{"source": obj["url"], "section": obj["section"]} for obj in docs_from_file],
-)
+    Входные данные:
+        merged_sources - ID фрагмента -> список всех его источников
 
-vector_store.add_documents(documents=documents)
\ No newline at end of file
+    Выходные данные:
+        Число фрагментов с изменёнными метаданными
+    """
+    ids, metadatas = [], []
+    offset = 0
+    while True:
+        page = vector_store.get(include=["metadatas"], limit=page_size, offset=offset)
+        for doc_id, metadata in zip(page["ids"], page["metadatas"]):
+            sources = merged_sources.get(doc_id)
+            expected = join_sources(sources) if sources and len(sources) > 1 else None
+            if (metadata or {}).get("sources") != expected:
+                ids.append(doc_id)
+                # None удаляет поле из метаданных
+                metadatas.append({"sources": expected})
+        if len(page["ids"]) < page_size:
+            break
+        offset += page_size
+    for i in range(0, len(ids), page_size):
+        vector_store._collection.update(ids=ids[i:i + page_size], metadatas=metadatas[i:i + page_size])
+    return len(ids)
+
+def embed_and_store(vector_store, embeddings, chunks, batch_size, workers):
+    """
+    Подсчёт эмбеддингов потока фрагментов пачками по batch_size штук в workers
+    потоков и запись их в коллекцию по мере готовности, с выводом прогресса.
+    Одновременно в обработке находится не больше 2 * workers пачек, поэтому
+    чтение и разбиение файла идут параллельно с подсчётом эмбеддингов,
+    а потребление памяти не зависит от размера файла.
+
+    Входные данные:
+        chunks - поток пар (фрагмент, ID фрагмента)
+
+    Выходные данные:
+        Число записанных фрагментов
+    """
+    start = time.perf_counter()
+    done = 0
+
+    def store(future):
+        nonlocal done
+        batch_docs, batch_ids, vectors = future.result()
+        vector_store._collection.upsert(
+            ids=batch_ids,
+            embeddings=vectors,
+            documents=[d.page_content for d in batch_docs],
+            metadatas=[d.metadata for d in batch_docs],
+        )
+        done += len(batch_docs)
+        elapsed = time.perf_counter() - start
+        print(f"Embedded {done} chunks, {done / elapsed:.1f} chunks/s")
+
+    def embed(batch):
+        batch_docs = [d for d, _ in batch]
+        return batch_docs, [i for _, i in batch], embeddings.embed_documents([d.page_content for d in batch_docs])
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batched(chunks, batch_size):
+            if len(pending) >= 2 * workers:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    store(future)
+            pending.add(executor.submit(embed, batch))
+        for future in wait(pending).done:
+            store(future)
+    return done
+
+def main():
+    args = parse_args()
+
+    print('Remember that embeddings in the db_creator and those in the main app should be the same!')
+    print('Are you ready to proceed? (Y/y for positive answer, anything else for negative)')
+
+    if input().lower() != 'y':
+        quit()
+
+    embeddings = OllamaEmbeddings(
+        model="qwen3-embedding",
+    )
+
+    vector_store = Chroma(
+        collection_name=args.collection_name,
+        embedding_function=embeddings,
+        persist_directory=args.db_path,  # Where to save data locally, remove if not necessary
+    )
+
+    if args.incremental:
+        existing_ids = get_existing_ids(vector_store)
+    else:
+        vector_store.reset_collection()
+        existing_ids = set()
+
+    splitter = RecursiveCharacterTextSplitter(
+        separators=["\n\n", ".", " "],
+        chunk_size=1000,
+        chunk_overlap=100,
+    )
+
+    # Записи читаются, разбиваются на фрагменты и отправляются на подсчёт
+    # эмбеддингов потоково, без загрузки всего файла в память
+    current_ids = set()
+    documents = split_records(iter_records(args.docs_filename), splitter)
+    # Почти дублирующие фрагменты (общие для многих страниц блоки, повторы заголовков)
+    # отбрасываются до подсчёта эмбеддингов, их источники сохраняются у оставленного фрагмента
+    merged_sources, dedup_stats = {}, {}
+    if not args.no_dedup:
+        documents = drop_near_duplicates(
+            documents, chunk_id, NearDuplicateFilter(args.dedup_threshold), merged_sources, dedup_stats,
+        )
+    chunks = select_chunks(documents, existing_ids, current_ids)
+    # Запросы к модели эмбеддингов идут через тот же механизм объединения в пачки, что и в основном
+    # приложении: workers потоков, пачки не больше batch_size фрагментов
+    broker = EmbeddingBroker(embeddings, args.batch_size, workers=args.workers)
+    embedded = embed_and_store(vector_store, broker, chunks, args.batch_size, args.workers)
+
+    vanished_ids = [i for i in existing_ids if i not in current_ids]
+    for i in range(0, len(vanished_ids), args.batch_size):
+        vector_store.delete(ids=vanished_ids[i:i + args.batch_size])
+
+    print(f"Chunks: {len(current_ids)} total, {len(current_ids) - embedded} unchanged, "
+          f"{embedded} embedded, {len(vanished_ids)} deleted")
+    if dedup_stats.get("seen"):
+        dropped, seen = dedup_stats.get("dropped", 0), dedup_stats["seen"]
+        dropped_chars = dedup_stats.get("dropped_chars", 0)
+        print(f"Near-duplicates: {dropped} of {seen} chunks dropped ({100 * dropped / seen:.1f}% of chunks, "
+              f"{100 * dropped_chars / max(dedup_stats['seen_chars'], 1):.1f}% of text), "
+              f"{sum(len(s) > 1 for s in merged_sources.values())} chunks keep the sources of their duplicates")
+    resourced = sync_sources(vector_store, merged_sources)
+
+    # Лексический индекс и NumPy-копия строятся по всем фрагментам коллекции, а не только
+    # по новым, поэтому после инкрементального обновления они тоже соответствуют содержимому БД
+    index_path = lexical_index_path(args.db_path, args.collection_name)
+    if embedded or vanished_ids or not args.incremental or not os.path.exists(index_path):
+        indexed = build_lexical_index(iter_collection_texts(vector_store), index_path)
+        print(f"Lexical index: {indexed} chunks")
+    numpy_path = numpy_index_path(args.db_path, args.collection_name)
+    if embedded or vanished_ids or resourced or not args.incremental or not os.path.exists(numpy_path):
+        exported = export_numpy_index(vector_store, numpy_path)
+        print(f"NumPy index: {exported} chunks")
+    sections_path = section_index_path(args.db_path, args.collection_name)
+    if embedded or vanished_ids or not args.incremental or not os.path.exists(sections_path):
+        sections = build_section_index(iter_section_vectors(vector_store), sections_path)
+        print(f"Section index: {sections} sections")
+
+    # Кэши основного приложения, зависящие от содержимого БД, сбрасываются при смене версии
+    if embedded or vanished_ids or resourced or not args.incremental:
+        bump_collection_version(args.db_path, args.collection_name)
+
+if __name__ == "__main__":
+    main()
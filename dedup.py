@@ -0,0 +1,119 @@
+import zlib
+from typing import Dict, Hashable, List, Optional
+import numpy as np
+from lexical_index import tokenize
+
+# Простое число для универсального хэширования (2^32 - 5): коэффициенты и хэши
+# меньше 2^32, поэтому a * x + b < 2^64 вычисляется в uint64 без переполнения
+HASH_PRIME = (1 << 32) - 5
+
+class NearDuplicateFilter:
+    """
+    Поиск почти дублирующих текстов при помощи MinHash и LSH:
+    - текст представляется множеством последовательностей из shingle_size
+      подряд идущих термов, а множество - MinHash-сигнатурой из num_perm чисел;
+    - сигнатура делится на bands полос, тексты с совпадающей полосой
+      становятся кандидатами в дубликаты (в корзине полосы хранятся все
+      такие тексты, а не только первый);
+    - кандидат считается дубликатом, если оценка коэффициента Жаккара по
+      сигнатурам не меньше threshold.
+    Хранятся только сигнатуры добавленных текстов, поэтому фильтр подходит
+    для потоковой обработки. Хэш-функции фиксированы (seed), так что при
+    повторных запусках на тех же данных результат не меняется.
+    """
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, bands: int = 32,
+                 shingle_size: int = 5, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, HASH_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, HASH_PRIME, num_perm, dtype=np.uint64)
+        self.signatures = {}
+        self.buckets = [{} for _ in range(bands)]
+
+    def shingle_hashes(self, text: str):
+        tokens = tokenize(text)
+        size = min(self.shingle_size, len(tokens)) or 1
+        shingles = {" ".join(tokens[i:i + size]) for i in range(max(len(tokens) - size + 1, 1))}
+        return np.array([zlib.crc32(s.encode("utf-8")) % HASH_PRIME for s in shingles], dtype=np.uint64)
+
+    def signature(self, text: str):
+        """
+        MinHash-сигнатура текста: для каждой хэш-функции (a * x + b) mod p
+        минимум по хэшам последовательностей термов. Все значения меньше
+        p = HASH_PRIME < 2^32, так что сигнатура хранится в uint32 без потерь
+        """
+        hashes = self.shingle_hashes(text)
+        return ((np.outer(hashes, self.a) + self.b) % np.uint64(HASH_PRIME)).min(axis=0).astype(np.uint32)
+
+    def band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def find(self, signature) -> Optional[Hashable]:
+        """
+        Поиск добавленного ранее текста, почти совпадающего с текстом сигнатуры signature
+
+        Выходные данные:
+            Ключ найденного текста или None
+        """
+        checked = set()
+        for bucket, band in zip(self.buckets, self.band_keys(signature)):
+            for key in bucket.get(band, ()):
+                if key in checked:
+                    continue
+                checked.add(key)
+                if np.mean(self.signatures[key] == signature) >= self.threshold:
+                    return key
+        return None
+
+    def add(self, key: Hashable, signature):
+        self.signatures[key] = signature
+        for bucket, band in zip(self.buckets, self.band_keys(signature)):
+            bucket.setdefault(band, []).append(key)
+
+def join_sources(sources: List[str]):
+    """
+    Значение поля метаданных "sources": Chroma хранит в метаданных
+    только скалярные значения, поэтому источники записываются через пробел
+    """
+    return " ".join(sources)
+
+def split_sources(value: Optional[str]):
+    """
+    Список источников из значения поля метаданных "sources", см. join_sources
+    """
+    return value.split() if value else []
+
+def drop_near_duplicates(documents, key_func, duplicate_filter: NearDuplicateFilter,
+                         merged_sources: Dict[Hashable, List[str]], stats: Dict[str, int]):
+    """
+    Отбрасывание фрагментов, почти совпадающих с встреченными ранее. Источник
+    отброшенного фрагмента добавляется к источникам оставленного: в merged_sources
+    по ключу оставленного фрагмента (key_func) накапливаются все источники его
+    дубликатов, начиная с его собственного. В stats подсчитываются
+    просмотренные ("seen") и отброшенные ("dropped") фрагменты и их символы.
+
+    Выходные данные:
+        Генератор оставленных фрагментов
+    """
+    kept_sources = {}
+    for document in documents:
+        stats["seen"] = stats.get("seen", 0) + 1
+        stats["seen_chars"] = stats.get("seen_chars", 0) + len(document.page_content)
+        signature = duplicate_filter.signature(document.page_content)
+        original = duplicate_filter.find(signature)
+        if original is None:
+            key = key_func(document)
+            kept_sources[key] = document.metadata["source"]
+            duplicate_filter.add(key, signature)
+            yield document
+            continue
+        stats["dropped"] = stats.get("dropped", 0) + 1
+        stats["dropped_chars"] = stats.get("dropped_chars", 0) + len(document.page_content)
+        sources = merged_sources.setdefault(original, [kept_sources[original]])
+        if document.metadata["source"] not in sources:
+            sources.append(document.metadata["source"])
@@ -0,0 +1,116 @@
+import json
+from typing import Iterator, Iterable, List, TypeVar
+
+T = TypeVar("T")
+
+def iter_json_array(file, read_size: int = 1 << 16) -> Iterator[dict]:
+    """
+    Потоковый разбор JSON-массива: записи возвращаются по одной по мере чтения
+    файла, в памяти одновременно находится только текущая запись и буфер чтения.
+
+    Входные данные:
+        file - открытый на чтение текстовый файл, позиция - перед '['
+        read_size - размер порции чтения файла в символах
+
+    Выходные данные:
+        Генератор элементов массива
+
+    Исключения:
+        json.JSONDecodeError - файл не является корректным JSON-массивом
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(read_size).lstrip()
+    if not buffer.startswith("["):
+        raise json.JSONDecodeError("Expected '['", buffer, 0)
+    pos = 1
+    eof = False
+    expect_value = True
+    while True:
+        # Пропуск пробельных символов и разделителей между элементами
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            chunk = file.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+        if pos >= len(buffer):
+            raise json.JSONDecodeError("Unexpected end of JSON array", buffer, pos)
+        if buffer[pos] == "]":
+            return
+        if not expect_value:
+            if buffer[pos] != ",":
+                raise json.JSONDecodeError("Expected ',' or ']'", buffer, pos)
+            pos += 1
+            expect_value = True
+            continue
+        try:
+            obj, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Элемент не поместился в буфер целиком - дочитываем файл
+            if eof:
+                raise
+            chunk = file.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        if end == len(buffer) and not eof:
+            # Число в конце буфера может быть прочитано не полностью
+            chunk = file.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield obj
+        pos = end
+        expect_value = False
+        if pos > read_size:
+            buffer, pos = buffer[pos:], 0
+
+def iter_jsonl(file) -> Iterator[dict]:
+    """
+    Построчный разбор JSONL-файла (одна JSON-запись на строку, пустые строки пропускаются)
+    """
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def iter_records(filename: str) -> Iterator[dict]:
+    """
+    Потоковое чтение записей из JSON-файла (массив записей) или JSONL-файла.
+    Формат определяется по первому непробельному символу файла: '[' - JSON-массив,
+    иначе - JSONL.
+
+    Входные данные:
+        filename - путь к файлу
+
+    Выходные данные:
+        Генератор записей
+    """
+    with open(filename, 'r', encoding='utf-8') as file:
+        first = ""
+        while True:
+            first = file.read(1)
+            if not first or not first.isspace():
+                break
+        if not first:
+            return
+        file.seek(0)
+        if first == "[":
+            yield from iter_json_array(file)
+        else:
+            yield from iter_jsonl(file)
+
+def batched(items: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    """
+    Разбиение потока элементов на списки по batch_size элементов (последний может быть короче)
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,75 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+from langchain_core.embeddings import Embeddings
+from metrics import EMBEDDING_BATCH_SIZE
+
+class EmbeddingBroker(Embeddings):
+    """
+    Обёртка над эмбеддингами, объединяющая одновременные запросы в пачки:
+    тексты, поступившие в течение max_wait секунд после первого (но не больше
+    max_batch_size), отправляются модели одним вызовом embed_documents, а
+    результаты раздаются ожидающим. Пачки обрабатываются в workers потоках,
+    повторяющиеся внутри пачки тексты считаются один раз. Подходит для моделей,
+    у которых эмбеддинг запроса совпадает с эмбеддингом документа (OllamaEmbeddings).
+    """
+    def __init__(self, embeddings: Embeddings, max_batch_size: int = 32, max_wait: float = 0.005,
+                 workers: int = 2):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        for i in range(workers):
+            threading.Thread(target=self.run, name=f"embedding-broker-{i}", daemon=True).start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.process(batch)
+
+    def process(self, batch):
+        # Запросы, ожидание которых уже отменено, не считаются
+        batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        EMBEDDING_BATCH_SIZE.observe(len(texts))
+        try:
+            vectors = self.embeddings.embed_documents(texts)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            future.set_result(by_text[text])
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self.queue.put((text, future))
+        return future
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.submit(text).result()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        futures = [self.submit(text) for text in texts]
+        return [future.result() for future in futures]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return list(await asyncio.gather(*[asyncio.wrap_future(self.submit(text)) for text in texts]))
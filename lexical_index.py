@@ -0,0 +1,162 @@
+import json
+import math
+import os
+import re
+import shutil
+from collections import Counter
+from typing import Iterable, List, Tuple
+import numpy as np
+
+# Слова обрезаются до STEM_LENGTH символов - грубая замена стемминга,
+# позволяющая находить разные словоформы ("компания", "компании")
+STEM_LENGTH = 6
+TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text: str):
+    """
+    Разбиение текста на термы для лексического индекса
+    """
+    return [token[:STEM_LENGTH] for token in TOKEN_RE.findall(text.lower())]
+
+def lexical_index_path(db_path: str, collection_name: str):
+    """
+    Папка лексического индекса коллекции - рядом с файлами векторной БД
+    """
+    return os.path.join(db_path, f"{collection_name}_bm25")
+
+def build_lexical_index(chunks: Iterable[Tuple[str, str]], path: str, k1: float = 1.5, b: float = 0.75):
+    """
+    Построение BM25-индекса по фрагментам и сохранение его в папку path.
+    Индекс сначала пишется во временную папку, которая затем заменяет старый
+    индекс, так что работающее приложение не увидит недописанный индекс.
+
+    Входные данные:
+        chunks - поток пар (ID фрагмента в векторной БД, текст фрагмента)
+        path - папка для сохранения индекса
+        k1, b - параметры BM25
+
+    Выходные данные:
+        Число проиндексированных фрагментов
+    """
+    doc_ids = []
+    doc_lengths = []
+    postings = {}
+    for doc_id, text in chunks:
+        tokens = tokenize(text)
+        doc_number = len(doc_ids)
+        doc_ids.append(doc_id)
+        doc_lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term, []).append((doc_number, tf))
+
+    vocabulary = {}
+    docs = []
+    tfs = []
+    for term, term_postings in postings.items():
+        vocabulary[term] = [len(docs), len(term_postings)]
+        docs.extend(d for d, _ in term_postings)
+        tfs.extend(tf for _, tf in term_postings)
+
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "postings_docs.npy"), np.asarray(docs, dtype=np.int32))
+    np.save(os.path.join(tmp_path, "postings_tf.npy"), np.asarray(tfs, dtype=np.float32))
+    np.save(os.path.join(tmp_path, "doc_lengths.npy"), np.asarray(doc_lengths, dtype=np.float32))
+    with open(os.path.join(tmp_path, "vocabulary.json"), 'w', encoding='utf-8') as file:
+        json.dump(vocabulary, file, ensure_ascii=False)
+    with open(os.path.join(tmp_path, "doc_ids.json"), 'w', encoding='utf-8') as file:
+        json.dump(doc_ids, file)
+    with open(os.path.join(tmp_path, "meta.json"), 'w', encoding='utf-8') as file:
+        avgdl = float(np.mean(doc_lengths)) if doc_lengths else 0.0
+        json.dump({"k1": k1, "b": b, "avgdl": avgdl, "stem_length": STEM_LENGTH}, file)
+
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return len(doc_ids)
+
+class LexicalIndex:
+    """
+    BM25-индекс, построенный build_lexical_index. Массивы индекса
+    отображаются в память (mmap), а не читаются целиком при запуске.
+    """
+    def __init__(self, path: str):
+        self.postings_docs = np.load(os.path.join(path, "postings_docs.npy"), mmap_mode="r")
+        self.postings_tf = np.load(os.path.join(path, "postings_tf.npy"), mmap_mode="r")
+        self.doc_lengths = np.load(os.path.join(path, "doc_lengths.npy"), mmap_mode="r")
+        with open(os.path.join(path, "vocabulary.json"), 'r', encoding='utf-8') as file:
+            self.vocabulary = json.load(file)
+        with open(os.path.join(path, "doc_ids.json"), 'r', encoding='utf-8') as file:
+            self.doc_ids = json.load(file)
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+        self.avgdl = meta["avgdl"] or 1.0
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """
+        Поиск k фрагментов с наибольшей BM25-оценкой относительно запроса
+
+        Выходные данные:
+            Список пар (ID фрагмента, оценка) по убыванию оценки
+        """
+        n_docs = len(self.doc_ids)
+        docs_parts = []
+        scores_parts = []
+        for term in set(tokenize(query)):
+            entry = self.vocabulary.get(term)
+            if entry is None:
+                continue
+            offset, df = entry
+            docs = self.postings_docs[offset:offset + df]
+            tf = self.postings_tf[offset:offset + df]
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avgdl)
+            docs_parts.append(docs)
+            scores_parts.append(idf * tf * (self.k1 + 1) / (tf + norm))
+        if not docs_parts:
+            return []
+        unique_docs, inverse = np.unique(np.concatenate(docs_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores_parts))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.doc_ids[unique_docs[i]], float(scores[i])) for i in top]
+
+def load_lexical_index(db_path: str, collection_name: str):
+    """
+    Загрузка лексического индекса коллекции, построенного db_creator.py
+
+    Входные данные:
+        db_path - путь к папке БД
+        collection_name - имя коллекции в БД
+
+    Выходные данные:
+        LexicalIndex, либо None, если индекс ещё не построен
+    """
+    path = lexical_index_path(db_path, collection_name)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    return LexicalIndex(path)
+
+def reciprocal_rank_fusion(rankings: Iterable[List[str]], k: int, rrf_k: int = 60):
+    """
+    Объединение нескольких ранжированных списков ID методом reciprocal rank fusion:
+    оценка ID - сумма 1 / (rrf_k + позиция) по всем спискам
+
+    Выходные данные:
+        k ID с наибольшей оценкой, по убыванию оценки
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, List, Optional, Set
+import httpx
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import ConfigDict, PrivateAttr
+from metrics import LLM_PROVIDER_REQUESTS, LLM_HEDGED_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Интервал проверки освобождения провайдеров при ожидании, в секундах
+POLL_INTERVAL = 0.05
+
+class NoProviderAvailable(RuntimeError):
+    """
+    Ни один провайдер пула не освободился за отведённое время
+    """
+
+class Provider:
+    """
+    LLM-провайдер пула: модель, ограничение числа одновременных запросов
+    к ней и состояние после ошибок (число ошибок подряд, время до которого
+    провайдер не используется)
+    """
+    def __init__(self, name: str, model: BaseChatModel, max_concurrency: int):
+        self.name = name
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+def status_code(error: Exception):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    # ollama.ResponseError без известного кода ответа имеет status_code == -1
+    return status if isinstance(status, int) and status > 0 else None
+
+def is_rate_limited(error: Exception):
+    return status_code(error) == 429
+
+def is_retryable(error: Exception):
+    """
+    Является ли ошибка сбоем провайдера, после которого запрос имеет смысл
+    повторить на другом провайдере: ответ 429 или 5xx, превышение времени
+    ожидания, ошибка соединения. Остальные ошибки (например, 400 на слишком
+    длинный промпт) относятся к самому запросу и повторятся на любом провайдере.
+    """
+    status = status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError, openai.APIConnectionError))
+
+def retry_after(error: Exception):
+    """
+    Время ожидания из заголовка Retry-After ответа с ошибкой, в секундах, либо None
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class LLMPool(BaseChatModel):
+    """
+    Модель, распределяющая запросы между несколькими LLM-провайдерами.
+    Провайдеры перебираются в порядке приоритета, запрос отправляется первому,
+    у которого меньше max_concurrency запросов в обработке и который не
+    отстранён после ошибки. При сбое провайдера (см. is_retryable) он отстраняется
+    на время из заголовка Retry-After (для ответов 429) или на backoff_base * 2^(n-1)
+    секунд после n сбоев подряд (но не больше backoff_max), а запрос повторяется
+    на следующем провайдере. Прочие ошибки сразу передаются вызывающему. Если задан hedge_after и ответ не получен за это время,
+    тот же запрос параллельно отправляется другому свободному провайдеру и
+    используется первый полученный ответ. Потоковые запросы при ошибке до первого
+    токена также переходят на следующий провайдер, но не дублируются.
+    """
+    providers: List[Any]
+    hedge_after: Optional[float] = None
+    backoff_base: float = 1.0
+    backoff_max: float = 60.0
+    acquire_timeout: float = 60.0
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _executor: Any = PrivateAttr(default=None)
+
+    @property
+    def _llm_type(self):
+        return "llm-pool"
+
+    @property
+    def _identifying_params(self):
+        return {"providers": [p.name for p in self.providers], "hedge_after": self.hedge_after}
+
+    def bind_tools(self, tools, **kwargs):
+        # Все модели пула (ChatOpenAI, ChatOllama) принимают тулы в формате OpenAI
+        return super().bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def try_acquire(self, tried: Set[str]):
+        """
+        Выбор свободного провайдера, которому ещё не отправлялся этот запрос
+
+        Выходные данные:
+            Пара (провайдер или None, есть ли ещё не опробованные провайдеры)
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [p for p in self.providers if p.name not in tried]
+            for p in candidates:
+                if p.cooldown_until <= now and p.in_flight < p.max_concurrency:
+                    p.in_flight += 1
+                    tried.add(p.name)
+                    return p, True
+            return None, bool(candidates)
+
+    def acquire(self, tried: Set[str], block: bool = True):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            provider, remaining = self.try_acquire(tried)
+            if provider is not None or not remaining or not block:
+                return provider
+            if time.monotonic() > deadline:
+                raise NoProviderAvailable("No LLM provider became available")
+            time.sleep(POLL_INTERVAL)
+
+    async def aacquire(self, tried: Set[str], block: bool = True):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            provider, remaining = self.try_acquire(tried)
+            if provider is not None or not remaining or not block:
+                return provider
+            if time.monotonic() > deadline:
+                raise NoProviderAvailable("No LLM provider became available")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def release(self, provider: Provider, error: Optional[Exception] = None, cancelled: bool = False):
+        """
+        Освобождение провайдера после запроса. Провайдер отстраняется только
+        после ошибок, для которых is_retryable: ошибка самого запроса
+        не меняет состояние провайдера.
+
+        Выходные данные:
+            Можно ли повторить запрос на другом провайдере
+        """
+        with self._lock:
+            provider.in_flight -= 1
+            if cancelled:
+                return False
+            if error is None:
+                provider.failures = 0
+                LLM_PROVIDER_REQUESTS.inc(provider=provider.name, outcome="ok")
+                return False
+            if not is_retryable(error):
+                LLM_PROVIDER_REQUESTS.inc(provider=provider.name, outcome="request_error")
+                return False
+            provider.failures += 1
+            delay = retry_after(error) if is_rate_limited(error) else None
+            if delay is None:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (provider.failures - 1))
+            provider.cooldown_until = time.monotonic() + delay
+        outcome = "rate_limited" if is_rate_limited(error) else "error"
+        LLM_PROVIDER_REQUESTS.inc(provider=provider.name, outcome=outcome)
+        logger.warning("LLM provider %s failed (%s), suspended for %.1f s", provider.name, error, delay)
+        return True
+
+    def generate_with_failover(self, tried: Set[str], messages, stop=None, block: bool = True, **kwargs):
+        """
+        Выполнение запроса с переходом на следующий провайдер при ошибке
+        """
+        last_error = None
+        while True:
+            provider = self.acquire(tried, block)
+            if provider is None:
+                raise last_error or NoProviderAvailable("No LLM provider is available")
+            try:
+                result = provider.model._generate(messages, stop=stop, **kwargs)
+            except Exception as e:
+                if not self.release(provider, e):
+                    raise
+                last_error = e
+                continue
+            self.release(provider)
+            return result
+
+    async def agenerate_with_failover(self, tried: Set[str], messages, stop=None, block: bool = True, **kwargs):
+        """
+        Асинхронный вариант generate_with_failover
+        """
+        last_error = None
+        while True:
+            provider = await self.aacquire(tried, block)
+            if provider is None:
+                raise last_error or NoProviderAvailable("No LLM provider is available")
+            try:
+                result = await provider.model._agenerate(messages, stop=stop, **kwargs)
+            except asyncio.CancelledError:
+                self.release(provider, cancelled=True)
+                raise
+            except Exception as e:
+                if not self.release(provider, e):
+                    raise
+                last_error = e
+                continue
+            self.release(provider)
+            return result
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tried = set()
+        if self.hedge_after is None:
+            return self.generate_with_failover(tried, messages, stop, **kwargs)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(thread_name_prefix="llm-pool")
+        pending = {self._executor.submit(self.generate_with_failover, tried, messages, stop, **kwargs)}
+        done, pending = wait(pending, timeout=self.hedge_after)
+        if not done:
+            LLM_HEDGED_REQUESTS.inc()
+            pending.add(self._executor.submit(self.generate_with_failover, tried, messages, stop, False, **kwargs))
+        error = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    # Оставшийся запрос нельзя прервать, его результат просто не используется
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                raise error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        tried = set()
+        if self.hedge_after is None:
+            return await self.agenerate_with_failover(tried, messages, stop, **kwargs)
+        pending = {asyncio.ensure_future(self.agenerate_with_failover(tried, messages, stop, **kwargs))}
+        error = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after)
+            if not done:
+                LLM_HEDGED_REQUESTS.inc()
+                pending.add(asyncio.ensure_future(self.agenerate_with_failover(tried, messages, stop, False, **kwargs)))
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        tried = set()
+        last_error = None
+        while True:
+            provider = self.acquire(tried)
+            if provider is None:
+                raise last_error or NoProviderAvailable("No LLM provider is available")
+            started = False
+            try:
+                for chunk in provider.model._stream(messages, stop=stop, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if not self.release(provider, e) or started:
+                    raise
+                last_error = e
+                continue
+            except BaseException:
+                self.release(provider, cancelled=True)
+                raise
+            self.release(provider)
+            return
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        tried = set()
+        last_error = None
+        while True:
+            provider = await self.aacquire(tried)
+            if provider is None:
+                raise last_error or NoProviderAvailable("No LLM provider is available")
+            started = False
+            try:
+                async for chunk in provider.model._astream(messages, stop=stop, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if not self.release(provider, e) or started:
+                    raise
+                last_error = e
+                continue
+            except BaseException:
+                self.release(provider, cancelled=True)
+                raise
+            self.release(provider)
+            return
@@ -1,7 +1,10 @@
-from langchain_openai import ChatOpenAI
 import os
 import getpass
-from langchain_ollama import ChatOllama
+from llm_pool import LLMPool, Provider
+from typing import List, Optional
+
+# Имя локальной модели Ollama
+LOCAL_MODEL_NAME = "gpt-oss:20b"
 
 model_data = {
     "GPT-4o" :
@@ -12,7 +15,8 @@ model_data = {
     "DeepSeek" :
     {
         "tokens" : 100,
-        "name" : "tngtech/deepseek-r1t2-chimera:free"
+        "name" : "tngtech/deepseek-r1t2-chimera:free",
+        "concurrency" : 2
     },
     "Grok":
     {
@@ -22,11 +26,12 @@ model_data = {
     "Nemotron":
     {
         "tokens": 200,
-        "name" : "nvidia/nemotron-nano-12b-v2-vl:free"
+        "name" : "nvidia/nemotron-nano-12b-v2-vl:free",
+        "concurrency" : 2
     }
 }
 
-def create_llm(use_local_model: bool, used_model_name: str=""):
+def create_llm(use_local_model: bool, used_model_name: str="", keep_alive: Optional[int] = None):
     """
     Создание LLM-модели по заданным параметрам, см. "входные данные"
 
@@ -39,20 +44,27 @@ def create_llm(use_local_model: bool, used_model_name: str=""):
 
         used_model_name: str - имя модели на OpenRouter.ai. Используется,
         если параметр use_local_model имеет значение False.
+
+        keep_alive: Optional[int] - время в секундах, в течение которого
+        локальная модель остаётся загруженной после запроса, None - по умолчанию Ollama.
     
     Выходные данные:
         Модель для использования в графе. Либо ChatOllama, либо ChatOpenAI,
         в зависимости от значения параметра use_local_model (True, False
         соответственно).
     """
+    # Клиенты моделей импортируются только при создании модели, это ускоряет запуск приложения
     if use_local_model:
+        from langchain_ollama import ChatOllama
         return ChatOllama(
-            model="gpt-oss:20b",
+            model=LOCAL_MODEL_NAME,
             temperature=0,
+            keep_alive=keep_alive,
         )
     if not os.environ.get("OPENROUTER_API_KEY"):
         os.environ["OPENROUTER_API_KEY"] = getpass.getpass("Enter API key for OpenRouter: ")
 
+    from langchain_openai import ChatOpenAI
     return ChatOpenAI(
         max_tokens=model_data[used_model_name]["tokens"],
         api_key=os.environ["OPENROUTER_API_KEY"],
@@ -62,4 +74,47 @@ def create_llm(use_local_model: bool, used_model_name: str=""):
             "HTTP-Referer": "YOUR_SITE_URL", # Optional. Site URL for rankings on openrouter.ai.
             "X-Title": "YOUR_SITE_NAME", # Optional. Site title for rankings on openrouter.ai.
         }
-    )
\ No newline at end of file
+    )
+
+# Имя локальной модели в списке провайдеров пула, см. create_llm_pool
+LOCAL_PROVIDER = "local"
+
+def create_llm_pool(provider_names: List[str], max_concurrency: int, hedge_after: Optional[float] = None,
+                    keep_alive: Optional[int] = None):
+    """
+    Создание пула LLM-моделей с переходом на следующую модель при ошибках
+    и превышении лимитов запросов, см. llm_pool.LLMPool
+
+    Входные данные:
+        provider_names: List[str] - модели пула в порядке приоритета: имена из
+        model_data (OpenRouter) и LOCAL_PROVIDER для локальной модели.
+
+        max_concurrency: int - максимальное число одновременных запросов
+        к одной модели, если для неё в model_data не задано "concurrency".
+
+        hedge_after: Optional[float] - время в секундах, после которого запрос
+        дублируется другой модели пула, None - не дублировать.
+
+        keep_alive: Optional[int] - см. create_llm.
+
+    Выходные данные:
+        LLMPool
+    """
+    providers = []
+    for name in provider_names:
+        if name == LOCAL_PROVIDER:
+            providers.append(Provider(name, create_llm(True, keep_alive=keep_alive), max_concurrency))
+        else:
+            concurrency = model_data[name].get("concurrency", max_concurrency)
+            providers.append(Provider(name, create_llm(False, name), concurrency))
+    return LLMPool(providers=providers, hedge_after=hedge_after)
+
+def local_models(llm):
+    """
+    Локальные модели (ChatOllama), используемые llm: сама llm
+    либо локальная модель пула (см. create_llm_pool)
+    """
+    if isinstance(llm, LLMPool):
+        return [p.model for p in llm.providers if p.name == LOCAL_PROVIDER]
+    from langchain_ollama import ChatOllama
+    return [llm] if isinstance(llm, ChatOllama) else []
@@ -1,25 +1,256 @@
-from fastapi import FastAPI
-from config import USE_LOCAL_MODEL, USED_MODEL, COLLECTION_NAME, embeddings
+import time
+IMPORT_START = time.perf_counter()
+
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Match
+from config import USE_LOCAL_MODEL, USED_MODEL, COLLECTION_NAME, VECTOR_STORE_BACKEND, embeddings
+from config import SESSION_BACKEND, SESSION_DB_PATH, MAX_SESSIONS, SESSION_TTL
+from config import EMBEDDING_MODEL, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH
+from config import EMBEDDING_BATCHING, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WAIT, EMBEDDING_BATCH_WORKERS
+from config import ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_SIZE
+from config import HYBRID_RETRIEVAL, SECTION_ROUTING, SECTION_MIN_CHUNKS, INIT_ON_STARTUP, LOG_LEVEL
+from config import BATCH_MAX_SIZE, BATCH_MAX_CONCURRENCY, BATCH_TIMEOUT
+from config import OLLAMA_KEEP_ALIVE, WARMUP_ENABLED, WARMUP_INTERVAL
+from config import LLM_POOL, LLM_POOL_MAX_CONCURRENCY, LLM_HEDGE_AFTER
+from config import RERANK_ENABLED, RERANK_BACKEND, CROSS_ENCODER_MODEL
+from config import ROUTER_ENABLED, ROUTER_KEYWORDS, ROUTER_RETRIEVE_THRESHOLD, ROUTER_RESPOND_THRESHOLD
+from caches import CachedEmbeddings, SemanticAnswerCache
+from embedding_broker import EmbeddingBroker
+from functools import partial
 from state import model_data
-from api_models import StringRequest, StringResponse
-from llms import create_llm
-from model import create_graph
+from api_models import StringRequest, StringResponse, BatchRequest, BatchResponse
+from llms import create_llm, create_llm_pool, local_models
+from model import create_graph, GENERATE_SYSTEM_PROMPT
+from langchain_core.messages import HumanMessage, SystemMessage
 from tools import retriever_tool
-from vector_store import load_vector_store
-from session_storage import SessionStorage
-from pipeline import process_request_fully
+from vector_store import load_vector_store, get_collection_version, DEFAULT_DB_PATH
+from lexical_index import load_lexical_index
+from section_index import load_section_index
+from reranker import create_reranker
+from router import QueryRouter
+from session_storage import create_session_storage, create_checkpointer
+from pipeline import aprocess_request_fully, aprocess_batch, astream_request
+from metrics import registry, register_cache_stats, HTTP_REQUESTS_IN_FLIGHT, HTTP_REQUEST_DURATION, STARTUP_DURATION
+import tools
+
+logging.basicConfig(level=LOG_LEVEL)
+logger = logging.getLogger(__name__)
+
+# Одновременные запросы к модели эмбеддингов объединяются в пачки
+query_embeddings = embeddings
+if EMBEDDING_BATCHING:
+    query_embeddings = EmbeddingBroker(embeddings, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WAIT, EMBEDDING_BATCH_WORKERS)
+
+# Эмбеддинги повторяющихся запросов берутся из кэша, без обращения к модели
+cached_embeddings = CachedEmbeddings(query_embeddings, EMBEDDING_MODEL, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH)
+
+def make_vector_db():
+    return load_vector_store(COLLECTION_NAME, cached_embeddings, VECTOR_STORE_BACKEND)
+
+def make_lexical_index():
+    if not HYBRID_RETRIEVAL:
+        return None
+    lexical_index = load_lexical_index(DEFAULT_DB_PATH, COLLECTION_NAME)
+    if lexical_index is None:
+        logger.warning("Лексический индекс не найден, используется только векторный поиск. "
+                       "Для его создания перезапустите db_creator.py")
+    return lexical_index
+
+def make_section_index():
+    if not SECTION_ROUTING:
+        return None
+    section_index = load_section_index(
+        DEFAULT_DB_PATH, COLLECTION_NAME, cached_embeddings,
+        partial(get_collection_version, DEFAULT_DB_PATH, COLLECTION_NAME),
+    )
+    if section_index is None:
+        logger.warning("Индекс разделов не найден, поиск выполняется по всей коллекции. "
+                       "Для его создания перезапустите db_creator.py")
+    elif section_index.chunks_per_section() < SECTION_MIN_CHUNKS:
+        # Индекс сохраняется: после пересоздания БД разделы могут стать крупнее, см. tools.restrict_to_sections
+        logger.warning("В среднем %.1f фрагмента на раздел, отбор разделов не сокращает поиск, "
+                       "поиск выполняется по всей коллекции", section_index.chunks_per_section())
+    return section_index
+
+def make_llm():
+    if LLM_POOL:
+        return create_llm_pool(LLM_POOL, LLM_POOL_MAX_CONCURRENCY, LLM_HEDGE_AFTER, OLLAMA_KEEP_ALIVE)
+    return create_llm(USE_LOCAL_MODEL, USED_MODEL, OLLAMA_KEEP_ALIVE)
+
+def make_reranker():
+    if not RERANK_ENABLED:
+        return None
+    return create_reranker(
+        RERANK_BACKEND, cached_embeddings, model_data.vector_db, CROSS_ENCODER_MODEL,
+        partial(get_collection_version, DEFAULT_DB_PATH, COLLECTION_NAME),
+    )
+
+def make_router():
+    if not ROUTER_ENABLED:
+        return None
+    return QueryRouter(
+        cached_embeddings, model_data.vector_db, ROUTER_KEYWORDS, ROUTER_RETRIEVE_THRESHOLD, ROUTER_RESPOND_THRESHOLD,
+    )
+
+checkpointer = create_checkpointer(SESSION_BACKEND, SESSION_DB_PATH)
+
+graph = create_graph(retriever_tool, checkpointer)
+
+# История удалённого сеанса удаляется и из чекпоинтера
+session_storage = create_session_storage(
+    SESSION_BACKEND, SESSION_DB_PATH, MAX_SESSIONS, SESSION_TTL,
+    on_evict=checkpointer.delete_thread,
+)
+
+answer_cache = None
+if ANSWER_CACHE_ENABLED:
+    answer_cache = SemanticAnswerCache(
+        cached_embeddings, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_SIZE,
+        partial(get_collection_version, DEFAULT_DB_PATH, COLLECTION_NAME),
+    )
+
+# LLM, векторная БД и зависящие от неё компоненты создаются не при импорте модуля,
+# а при первом обращении к ним или при фоновой инициализации после запуска сервера (см. lifespan)
+model_data.set_parameters(None, retriever_tool, None, session_storage, graph, answer_cache, embeddings=cached_embeddings)
+model_data.set_lazy(
+    llm=make_llm,
+    vector_db=make_vector_db,
+    lexical_index=make_lexical_index,
+    section_index=make_section_index,
+    reranker=make_reranker,
+    router=make_router,
+)
 
-vector_db = load_vector_store(COLLECTION_NAME, embeddings)
+caches = {"query_embedding": cached_embeddings.stats, "retrieval": tools.retrieval_cache.stats}
+if answer_cache is not None:
+    caches["answer"] = answer_cache.stats
+register_cache_stats(caches)
 
-llm = create_llm(USE_LOCAL_MODEL, USED_MODEL)
+STARTUP_DURATION.set(time.perf_counter() - IMPORT_START, component="import")
+logger.info("Модуль приложения загружен за %.2f с", time.perf_counter() - IMPORT_START)
 
-graph = create_graph(retriever_tool)
+async def initialize_components():
+    """
+    Создание ещё не созданных компонентов в отдельном потоке, не блокируя event loop.
+    При ошибке создания исключение пробрасывается, а компонент будет создаваться
+    заново при следующем обращении.
+    """
+    if model_data.pending():
+        await asyncio.to_thread(model_data.initialize)
+
+async def initialize_in_background():
+    start = time.perf_counter()
+    try:
+        await initialize_components()
+    except Exception:
+        logger.exception("Ошибка инициализации компонентов")
+        return
+    for name, seconds in model_data.init_times.items():
+        STARTUP_DURATION.set(seconds, component=name)
+    logger.info(
+        "Приложение готово за %.2f с после запуска сервера: %s", time.perf_counter() - start,
+        ", ".join(f"{name} {seconds:.2f} с" for name, seconds in model_data.init_times.items()),
+    )
+
+async def warm_up_models():
+    """
+    Прогрев локальных моделей: модель эмбеддингов и локальная LLM получают
+    по короткому запросу, что загружает их в память сервера Ollama (и продлевает
+    время до выгрузки, OLLAMA_KEEP_ALIVE). Запрос к LLM начинается с того же
+    системного сообщения, что и запросы генерации ответа, поэтому его префикс
+    попадает в кэш сервера модели. Эмбеддинги считаются без кэша эмбеддингов запросов.
+    """
+    await initialize_components()
+    start = time.perf_counter()
+    # Одного токена ответа достаточно, чтобы модель загрузилась и обработала промпт
+    warmup_prompt = [SystemMessage(content=GENERATE_SYSTEM_PROMPT), HumanMessage(content="Привет")]
+    await asyncio.gather(
+        asyncio.to_thread(embeddings.embed_query, "Привет"),
+        *[llm.ainvoke(warmup_prompt, options={"num_predict": 1}) for llm in local_models(model_data.llm)],
+    )
+    STARTUP_DURATION.set(time.perf_counter() - start, component="warmup")
+    logger.info("Локальные модели прогреты за %.2f с", time.perf_counter() - start)
+
+async def keep_models_warm():
+    """
+    Прогрев локальных моделей после запуска сервера и затем каждые WARMUP_INTERVAL секунд
+    """
+    while True:
+        try:
+            await warm_up_models()
+        except Exception:
+            logger.exception("Ошибка прогрева моделей")
+        if WARMUP_INTERVAL is None:
+            return
+        await asyncio.sleep(WARMUP_INTERVAL)
+
+async def require_components():
+    """
+    Ожидание создания компонентов перед обработкой запроса
+
+    Исключения:
+        HTTPException(503) - компоненты не удалось создать
+    """
+    try:
+        await initialize_components()
+    except Exception:
+        logger.exception("Ошибка инициализации компонентов")
+        raise HTTPException(status_code=503, detail="Сервис не готов к обработке запросов")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Запуск фоновой инициализации компонентов и прогрева моделей: сервер начинает
+    принимать соединения сразу, готовность сообщает endpoint "ready"
+    """
+    tasks = []
+    if INIT_ON_STARTUP:
+        tasks.append(asyncio.create_task(initialize_in_background()))
+    if WARMUP_ENABLED:
+        tasks.append(asyncio.create_task(keep_models_warm()))
+    yield
+    for task in tasks:
+        task.cancel()
 
-session_storage = SessionStorage()
+app = FastAPI(title="String Processor", lifespan=lifespan)
 
-model_data.set_parameters(llm, retriever_tool, vector_db, session_storage, graph)
+def route_label(request: Request):
+    """
+    Метка пути запроса в метриках - шаблон пути подходящего маршрута, чтобы
+    число меток не росло с числом разных запрошенных адресов
+    """
+    label = "unmatched"
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and label == "unmatched":
+            # Путь совпал, но метод нет (ответ 405)
+            label = route.path
+    return label
 
-app = FastAPI(title="String Processor")
+@app.middleware("http")
+async def collect_http_metrics(request: Request, call_next):
+    """
+    Учёт числа обрабатываемых HTTP-запросов и времени их обработки в метриках.
+    Для потоковых ответов учитывается время до начала передачи ответа.
+    """
+    path = route_label(request)
+    HTTP_REQUESTS_IN_FLIGHT.inc(path=path)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_REQUESTS_IN_FLIGHT.dec(path=path)
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, path=path, status=status)
 
 @app.post("/process-string", response_model=StringResponse)
 async def process_string(request: StringRequest):
@@ -27,6 +258,7 @@ async def process_string(request: StringRequest):
     Функция обработки endpoint'а "process-string".
     Принимает на вход строку, содержащую "question" и "session_id",
     Возвращает результат обработки "question" через LLM-граф.
+    Обработка выполняется асинхронно, не блокируя остальные запросы.
 
     Входные данные:
         request - строка запроса
@@ -36,12 +268,95 @@ async def process_string(request: StringRequest):
         "answer", "source_documents" и "session_id"
     """
     
-    print(f"Received request: {request}")
-    result = process_request_fully(request)
-    print(f"Result: {result}")
-    
+    logger.debug("Received request: %s", request)
+    await require_components()
+    try:
+        result = await aprocess_request_fully(request)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Превышено время обработки запроса")
+    logger.debug("Result: %s", result)
+    if result is None:
+        raise HTTPException(status_code=500, detail="Ошибка при обработке запроса")
+
     return StringResponse(answer=result['answer'], source_documents=result['source_documents'], session_id=result['session_id'])
 
+@app.post("/process-batch", response_model=BatchResponse)
+async def process_batch(request: BatchRequest):
+    """
+    Функция обработки endpoint'а "process-batch".
+    Принимает список строк запросов "process-string" и возвращает
+    результаты в том же порядке. Вопросы обрабатываются графом пакетно,
+    не более BATCH_MAX_CONCURRENCY одновременно; при ошибке обработки
+    вопроса соответствующий результат содержит поле "error".
+
+    Входные данные:
+        request - список строк запросов
+
+    Выходные данные:
+        BatchResponse - список результатов, каждый содержит
+        "answer", "source_documents" и "session_id" либо "error" и "session_id"
+    """
+    logger.debug("Received batch of %d requests", len(request.requests))
+    if len(request.requests) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"В пакете больше {BATCH_MAX_SIZE} вопросов")
+    await require_components()
+    try:
+        results = await asyncio.wait_for(aprocess_batch(request.requests, BATCH_MAX_CONCURRENCY), timeout=BATCH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Превышено время обработки пакета")
+    return BatchResponse(results=results)
+
+@app.post("/process-string-stream")
+async def process_string_stream(request: StringRequest):
+    """
+    Функция обработки endpoint'а "process-string-stream".
+    Принимает тот же запрос, что и "process-string", но отвечает потоком
+    Server-Sent Events: токены ответа передаются по мере генерации
+    (события {"type": "token", "content": ...}), последним событием
+    передаётся полный ответ в формате StringResponse с полем "type": "done",
+    либо ошибка {"type": "error", "detail": ...}.
+
+    Входные данные:
+        request - строка запроса
+
+    Выходные данные:
+        StreamingResponse с типом содержимого text/event-stream
+    """
+    logger.debug("Received stream request: %s", request)
+    await require_components()
+
+    async def events():
+        async for event in astream_request(request):
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Функция обработки endpoint'а "metrics": метрики приложения в текстовом формате Prometheus -
+    время работы узлов графа, эмбеддинга запросов и поиска в векторной БД, число токенов
+    в вызовах LLM, статистика кэшей, число обрабатываемых запросов.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+async def ready():
+    """
+    Функция обработки endpoint'а проверки готовности: код 200, если все компоненты
+    (LLM, векторная БД и т.д.) созданы и запросы будут обработаны без задержки
+    на инициализацию, иначе 503. В ответе - ещё не созданные компоненты, ошибки
+    их создания и время создания уже созданных.
+    """
+    pending = model_data.pending()
+    body = {
+        "ready": not pending,
+        "pending": pending,
+        "errors": model_data.init_errors,
+        "startup_seconds": {"import": STARTUP_DURATION.values.get(("import",)), **model_data.init_times},
+    }
+    return JSONResponse(body, status_code=200 if not pending else 503)
+
 @app.get("/")
 async def root():
     """
@@ -0,0 +1,76 @@
+import threading
+from collections import defaultdict
+from typing import Any, Sequence
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata
+from langgraph.checkpoint.memory import InMemorySaver
+
+class LatestInMemorySaver(InMemorySaver):
+    """
+    InMemorySaver, хранящий только последний чекпоинт каждого диалога.
+    InMemorySaver сохраняет все чекпоинты (несколько за ход диалога), их
+    промежуточные записи (writes) и все версии значений каналов, поэтому
+    занимаемая диалогом память растёт с числом ходов. Здесь при записи нового
+    чекпоинта предыдущие чекпоинты, их записи и не используемые им версии
+    каналов удаляются. Ключи записей и версий каналов каждого диалога
+    запоминаются, чтобы не просматривать при удалении данные всех диалогов.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        # (thread_id, checkpoint_ns) -> ключи self.writes и self.blobs этого диалога
+        self.write_keys = defaultdict(set)
+        self.blob_keys = defaultdict(set)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        with self.lock:
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            checkpoints = self.storage[thread_id][checkpoint_ns]
+            for checkpoint_id in [c for c in checkpoints if c != checkpoint["id"]]:
+                del checkpoints[checkpoint_id]
+            write_keys = self.write_keys[(thread_id, checkpoint_ns)]
+            # InMemorySaver.get_tuple создаёт пустую запись self.writes и для чекпоинта без записей
+            write_keys.add((thread_id, checkpoint_ns, checkpoint["id"]))
+            for key in [k for k in write_keys if k[2] != checkpoint["id"]]:
+                self.writes.pop(key, None)
+                write_keys.discard(key)
+            blob_keys = self.blob_keys[(thread_id, checkpoint_ns)]
+            blob_keys.update((thread_id, checkpoint_ns, k, v) for k, v in new_versions.items())
+            versions = checkpoint["channel_versions"]
+            for key in [k for k in blob_keys if versions.get(k[2]) != k[3]]:
+                self.blobs.pop(key, None)
+                blob_keys.discard(key)
+        return next_config
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        with self.lock:
+            super().put_writes(config, writes, task_id, task_path)
+            self.write_keys[(thread_id, checkpoint_ns)].add(
+                (thread_id, checkpoint_ns, config["configurable"]["checkpoint_id"])
+            )
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.lock:
+            self.storage.pop(thread_id, None)
+            for thread_key in [k for k in self.write_keys if k[0] == thread_id]:
+                for key in self.write_keys.pop(thread_key):
+                    self.writes.pop(key, None)
+            for thread_key in [k for k in self.blob_keys if k[0] == thread_id]:
+                for key in self.blob_keys.pop(thread_key):
+                    self.blobs.pop(key, None)
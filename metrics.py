@@ -0,0 +1,243 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, Tuple
+from langchain_core.callbacks import BaseCallbackHandler
+
+def format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = ""):
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    """
+    Базовый класс метрики в формате Prometheus: имя, описание, имена меток
+    и значения для каждого набора значений меток
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, str]):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + format_labels(self.labelnames, k), v) for k, v in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name} {value}" for name, value in self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class CallbackMetric(Metric):
+    """
+    Метрика, значения которой вычисляются при каждом чтении: callback
+    возвращает словарь {кортеж значений меток: значение}
+    """
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str],
+                 callback: Callable[[], Dict[Tuple[str, ...], float]], kind: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        return [(self.name + format_labels(self.labelnames, k), v) for k, v in self.callback().items()]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """
+        Контекстный менеджер, измеряющий время выполнения блока
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    samples.append((self.name + "_bucket" + format_labels(self.labelnames, key, f'le="{le}"'), cumulative))
+                samples.append((self.name + "_sum" + format_labels(self.labelnames, key), total))
+                samples.append((self.name + "_count" + format_labels(self.labelnames, key), cumulative))
+        return samples
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Registry:
+    """
+    Набор метрик приложения, выдаваемый endpoint'ом /metrics
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+registry = Registry()
+
+STARTUP_DURATION = registry.register(Gauge(
+    "nf_hw_startup_seconds", "Application startup time by component", ["component"]))
+HTTP_REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    "nf_hw_http_requests_in_flight", "HTTP requests being handled", ["path"]))
+HTTP_REQUEST_DURATION = registry.register(Histogram(
+    "nf_hw_http_request_duration_seconds", "HTTP request handling time", ["path", "status"]))
+GRAPH_RUNS_IN_FLIGHT = registry.register(Gauge(
+    "nf_hw_graph_runs_in_flight", "Graph runs being executed (after the concurrency limiter)"))
+GRAPH_RUNS_WAITING = registry.register(Gauge(
+    "nf_hw_graph_runs_waiting", "Graph runs waiting for the concurrency limiter"))
+NODE_DURATION = registry.register(Histogram(
+    "nf_hw_graph_node_duration_seconds", "Graph node execution time", ["node"]))
+LLM_TOKENS = registry.register(Counter(
+    "nf_hw_llm_tokens_total", "Tokens used by LLM calls", ["node", "type"]))
+LLM_CALLS = registry.register(Counter(
+    "nf_hw_llm_calls_total", "LLM calls", ["node"]))
+LLM_PROVIDER_REQUESTS = registry.register(Counter(
+    "nf_hw_llm_provider_requests_total", "Requests sent to LLM pool providers", ["provider", "outcome"]))
+LLM_HEDGED_REQUESTS = registry.register(Counter(
+    "nf_hw_llm_hedged_requests_total", "LLM requests duplicated to a second provider after the hedge delay"))
+EMBEDDING_DURATION = registry.register(Histogram(
+    "nf_hw_embedding_duration_seconds", "Query embedding time (cache misses only)"))
+EMBEDDING_BATCH_SIZE = registry.register(Histogram(
+    "nf_hw_embedding_batch_size", "Texts per batched embedding call", buckets=(1, 2, 4, 8, 16, 32, 64, 128)))
+VECTOR_QUERY_DURATION = registry.register(Histogram(
+    "nf_hw_vector_query_duration_seconds", "Vector store query time, excluding query embedding (cache misses only)"))
+ROUTER_DECISIONS = registry.register(Counter(
+    "nf_hw_router_decisions_total", "Question routing decisions (llm - decided by the LLM)", ["route"]))
+RERANK_DURATION = registry.register(Histogram(
+    "nf_hw_rerank_duration_seconds", "Retrieved chunks reranking time (cache misses only)"))
+
+def register_cache_stats(caches: Dict[str, Callable[[], Dict[str, float]]]):
+    """
+    Регистрация метрик кэшей: для каждого кэша передаётся функция stats(),
+    возвращающая словарь со счётчиками "hits", "misses" и размером "size"
+    """
+    def values(field):
+        def callback():
+            result = {}
+            for name, stats in caches.items():
+                value = stats().get(field)
+                if value is not None:
+                    result[(name,)] = value
+            return result
+        return callback
+
+    registry.register(CallbackMetric("nf_hw_cache_hits_total", "Cache hits", ["cache"], values("hits"), "counter"))
+    registry.register(CallbackMetric("nf_hw_cache_misses_total", "Cache misses", ["cache"], values("misses"), "counter"))
+    registry.register(CallbackMetric("nf_hw_cache_size", "Cache entries", ["cache"], values("size")))
+
+class GraphMetricsHandler(BaseCallbackHandler):
+    """
+    Callback-обработчик, собирающий время работы узлов графа (NODE_DURATION)
+    и число токенов в вызовах LLM по узлам (LLM_TOKENS, LLM_CALLS).
+    Передаётся в config каждого запуска графа.
+    """
+    run_inline = True
+
+    def __init__(self, nodes: Iterable[str]):
+        self.nodes = set(nodes)
+        self.runs = {}
+        self.llm_runs = {}
+        self.lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        name = kwargs.get("name")
+        if name not in self.nodes:
+            return
+        with self.lock:
+            # Узел и обёрнутая в него функция называются одинаково, учитывается только внешний запуск
+            parent = self.runs.get(parent_run_id)
+            if parent is not None and parent[0] == name:
+                return
+            self.runs[run_id] = (name, time.perf_counter())
+
+    def finish(self, run_id):
+        with self.lock:
+            run = self.runs.pop(run_id, None)
+        if run is not None:
+            NODE_DURATION.observe(time.perf_counter() - run[1], node=run[0])
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self.finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.finish(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        with self.lock:
+            self.llm_runs[run_id] = (metadata or {}).get("langgraph_node", "")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self.lock:
+            node = self.llm_runs.pop(run_id, "")
+        LLM_CALLS.inc(node=node)
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    LLM_TOKENS.inc(usage.get("input_tokens", 0), node=node, type="input")
+                    LLM_TOKENS.inc(usage.get("output_tokens", 0), node=node, type="output")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self.lock:
+            self.llm_runs.pop(run_id, None)
@@ -2,20 +2,216 @@ from langgraph.graph import MessagesState
 from langgraph.graph import StateGraph, START, END
 from langgraph.prebuilt import ToolNode, tools_condition
 from langgraph.checkpoint.memory import InMemorySaver
-from langchain_core.messages import HumanMessage
-from typing import Any
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, SystemMessage, ToolMessage
+from langchain_core.runnables import RunnableLambda
+from typing import Any, List
 from state import model_data
+from config import MAX_MESSAGES_PER_THREAD, LOG_PROMPTS_SAMPLE_RATE
+from config import HISTORY_WINDOW_TURNS, HISTORY_SUMMARY_ENABLED, HISTORY_SUMMARY_BATCH
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_CHARS_PER_TOKEN, CONTEXT_DUPLICATE_THRESHOLD
+from context_builder import assemble_context
+from router import ROUTE_RETRIEVE, ROUTE_RESPOND
+from metrics import ROUTER_DECISIONS
 import logging
+import random
+import uuid
 
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Имена узлов графа, см. create_graph
+GRAPH_NODES = ("trim_history", "generate_query_or_respond", "retrieve", "generate_answer")
 
 retriever_tool_state = None
-    
+
+def log_prompt(node: str, prompt: Any, response: Any):
+    """
+    Запись в лог промпта и ответа LLM для доли LOG_PROMPTS_SAMPLE_RATE вызовов
+    """
+    if LOG_PROMPTS_SAMPLE_RATE > 0 and random.random() < LOG_PROMPTS_SAMPLE_RATE:
+        logger.info("%s prompt=%s response=%s", node, prompt, response)
+
+# ID сообщения с кратким содержанием старой части диалога, см. trim_history
+HISTORY_SUMMARY_ID = "history_summary"
+# Текст, которым заменяются результаты тула в прошлых ходах диалога
+STRIPPED_TOOL_CONTENT = "[найденные документы опущены]"
+
+SUMMARY_PROMPT = (
+    "Кратко изложи содержание диалога пользователя с ассистентом, сохранив факты, имена, "
+    "названия и вопросы пользователя, которые могут понадобиться для продолжения разговора. "
+    "Ответь только кратким содержанием.\n"
+    "Краткое содержание более ранней части диалога: {summary}\n"
+    "Диалог:\n{dialog}"
+)
+
+def split_turns(messages: List[Any]):
+    """
+    Разбиение цепочки на ходы диалога, каждый из которых начинается с HumanMessage
+
+    Выходные данные:
+        Пара (сообщения до первого HumanMessage, список ходов)
+    """
+    prefix = []
+    turns = []
+    for msg in messages:
+        if type(msg) is HumanMessage:
+            turns.append([msg])
+        elif turns:
+            turns[-1].append(msg)
+        else:
+            prefix.append(msg)
+    return prefix, turns
+
+def strip_tool_payload(msg: Any):
+    """
+    Результат тула из прошлого хода диалога без найденных документов
+    (с тем же ID, т.е. заменяющий исходное сообщение в истории), либо None,
+    если сообщение заменять не нужно
+    """
+    if type(msg) is not ToolMessage or (msg.content == STRIPPED_TOOL_CONTENT and msg.artifact is None):
+        return None
+    return msg.model_copy(update={"content": STRIPPED_TOOL_CONTENT, "artifact": None})
+
+def plan_compaction(messages: List[Any]):
+    """
+    Определение изменений истории диалога перед обработкой нового вопроса:
+    - последние HISTORY_WINDOW_TURNS ходов (и текущий вопрос) сохраняются дословно,
+      но из прошлых ходов убираются результаты тула;
+    - более старые ходы удаляются; если включено HISTORY_SUMMARY_ENABLED, они
+      удаляются пачками по HISTORY_SUMMARY_BATCH ходов и заменяются кратким
+      содержанием, т.е. LLM вызывается только раз в несколько ходов;
+    - если сохраняемых сообщений больше MAX_MESSAGES_PER_THREAD, удаляются
+      самые старые ходы (без краткого содержания).
+
+    Выходные данные:
+        Тройка (сохраняемые сообщения, удаляемые ходы для краткого содержания,
+        текущее краткое содержание или None)
+    """
+    prefix, turns = split_turns(messages)
+    summary = next((m for m in prefix if m.id == HISTORY_SUMMARY_ID), None)
+    old_count = max(0, len(turns) - 1 - HISTORY_WINDOW_TURNS) if HISTORY_WINDOW_TURNS is not None else 0
+    if HISTORY_SUMMARY_ENABLED and old_count < HISTORY_SUMMARY_BATCH:
+        old_count = 0
+    old, recent = turns[:old_count], turns[old_count:]
+
+    kept = []
+    for i, turn in enumerate(recent):
+        for msg in turn:
+            stripped = strip_tool_payload(msg) if i < len(recent) - 1 else None
+            kept.append(stripped or msg)
+    if MAX_MESSAGES_PER_THREAD is not None and len(kept) > MAX_MESSAGES_PER_THREAD:
+        start = len(kept) - MAX_MESSAGES_PER_THREAD
+        while start < len(kept) - 1 and type(kept[start]) is not HumanMessage:
+            start += 1
+        kept = kept[start:]
+    if not HISTORY_SUMMARY_ENABLED:
+        old = []
+    if not old:
+        # Краткое содержание (если было) заменяется новым только при удалении ходов с кратким содержанием
+        kept = prefix + kept
+    return kept, old, summary
+
+def format_dialog(turns: List[List[Any]]):
+    lines = []
+    for turn in turns:
+        for msg in turn:
+            if type(msg) is HumanMessage:
+                lines.append(f"Пользователь: {msg.content}")
+            elif isinstance(msg, AIMessage) and msg.content:
+                lines.append(f"Ассистент: {msg.content}")
+    return "\n".join(lines)
+
+def build_summary_prompt(old: List[List[Any]], summary: Any):
+    return SUMMARY_PROMPT.format(summary=summary.content if summary is not None else "нет", dialog=format_dialog(old))
+
+def compaction_update(messages: List[Any], kept: List[Any], summary_text: Any = None):
+    """
+    Обновление состояния графа по результату plan_compaction
+    """
+    if len(kept) == len(messages) and all(a is b for a, b in zip(kept, messages)):
+        return {"messages": []}
+    if summary_text is None and {m.id for m in kept} == {m.id for m in messages}:
+        # Только замена результатов тула - сообщения с теми же ID заменяются на месте
+        return {"messages": [new for new, old in zip(kept, messages) if new is not old]}
+    update = [RemoveMessage(id=REMOVE_ALL_MESSAGES)]
+    if summary_text is not None:
+        update.append(SystemMessage(
+            content=f"Краткое содержание предыдущей части диалога: {summary_text}", id=HISTORY_SUMMARY_ID,
+        ))
+    return {"messages": update + kept}
+
+def trim_history(state: MessagesState):
+    """
+    Сжатие истории диалога перед обработкой нового вопроса (см. plan_compaction),
+    чтобы время обработки и размер промпта не росли с длиной диалога.
+
+    Входные данные:
+        state: MessagesState - обрабатываемый запрос вместе с историей диалога
+
+    Выходные данные:
+        Словарь "messages" - изменения истории диалога
+    """
+    messages = state["messages"]
+    kept, old, summary = plan_compaction(messages)
+    summary_text = None
+    if old:
+        prompt = build_summary_prompt(old, summary)
+        response = model_data.llm.invoke([{"role": "user", "content": prompt}])
+        log_prompt("trim_history", prompt, response)
+        summary_text = response.content
+    return compaction_update(messages, kept, summary_text)
+
+async def atrim_history(state: MessagesState):
+    """
+    Асинхронный вариант trim_history
+
+    Входные данные и выходные данные совпадают с trim_history
+    """
+    messages = state["messages"]
+    kept, old, summary = plan_compaction(messages)
+    summary_text = None
+    if old:
+        prompt = build_summary_prompt(old, summary)
+        response = await model_data.llm.ainvoke([{"role": "user", "content": prompt}])
+        log_prompt("trim_history", prompt, response)
+        summary_text = response.content
+    return compaction_update(messages, kept, summary_text)
+
+def make_retrieval_call(question: str):
+    """
+    Сообщение с вызовом тула поиска по вопросу пользователя - то же,
+    что вернула бы LLM, решив искать ответ в базе
+    """
+    return AIMessage(content="", tool_calls=[{
+        "name": retriever_tool_state.name,
+        "args": {"query": question},
+        "id": f"call_{uuid.uuid4().hex}",
+    }])
+
+def current_question(state: MessagesState):
+    """
+    Текст вопроса, если он - последнее сообщение цепочки, иначе None
+    """
+    last = state["messages"][-1]
+    return last.content if type(last) is HumanMessage and isinstance(last.content, str) else None
+
+def is_first_turn(state: MessagesState):
+    """
+    Является ли вопрос первым в диалоге: без предыдущих ходов и их краткого содержания
+    """
+    prefix, turns = split_turns(state["messages"])
+    return len(turns) == 1 and not any(m.id == HISTORY_SUMMARY_ID for m in prefix)
+
 def generate_query_or_respond(state: MessagesState):
     """
     Определить, нужно ли вызывать tool и, либо вызвать его
     и вернуть результат вызова, либо обратиться к LLM-модели
     за генерацией ответа, если tool вызывать не нужно.
+    Если задан model_data.router (см. router.QueryRouter), вопрос задан
+    первым в диалоге и маршрутизатор уверен в его маршруте, LLM для выбора
+    маршрута не вызывается: тул вызывается сразу, либо LLM отвечает без
+    возможности вызвать тул. Вопросы-продолжения всегда передаются LLM:
+    их текст без истории диалога не годится в качестве поискового запроса.
 
     Входные данные:
         state: MessageState - обрабатываемый запрос
@@ -24,26 +220,104 @@ def generate_query_or_respond(state: MessagesState):
         Словарь "messages": List[Union[ToolResponse, AIResponse]] -
             результат обработки запроса
     """
-    logging.debug(f"generate_query_or_respond entered")
-    response = (
-        model_data.llm
-        .bind_tools([retriever_tool_state]).invoke(state["messages"])  
-    )
-    logging.debug(f"generate_query_or_respond returns {response}")
+    llm = model_data.llm.bind_tools([retriever_tool_state])
+    question = current_question(state)
+    if model_data.router is not None and question is not None and is_first_turn(state):
+        route = model_data.router.route(question)
+        ROUTER_DECISIONS.inc(route=route or "llm")
+        if route == ROUTE_RETRIEVE:
+            return {"messages": [make_retrieval_call(question)]}
+        if route == ROUTE_RESPOND:
+            llm = model_data.llm
+    response = llm.invoke(state["messages"])
+    log_prompt("generate_query_or_respond", state["messages"], response)
     return {"messages": [response]}
 
-GENERATE_PROMPT = (
+async def agenerate_query_or_respond(state: MessagesState):
+    """
+    Асинхронный вариант generate_query_or_respond, используется
+    при обработке запроса через graph.ainvoke. Не блокирует event loop
+    на время обращения к LLM.
+
+    Входные данные и выходные данные совпадают с generate_query_or_respond
+    """
+    llm = model_data.llm.bind_tools([retriever_tool_state])
+    question = current_question(state)
+    if model_data.router is not None and question is not None and is_first_turn(state):
+        route = await model_data.router.aroute(question)
+        ROUTER_DECISIONS.inc(route=route or "llm")
+        if route == ROUTE_RETRIEVE:
+            return {"messages": [make_retrieval_call(question)]}
+        if route == ROUTE_RESPOND:
+            llm = model_data.llm
+    response = await llm.ainvoke(state["messages"])
+    log_prompt("generate_query_or_respond", state["messages"], response)
+    return {"messages": [response]}
+
+# Инструкции для генерации ответа передаются отдельным системным сообщением, одинаковым
+# во всех запросах, а контекст и вопрос - после него. Так все запросы начинаются
+# с общего префикса, который сервер модели может взять из кэша, а не считать заново
+GENERATE_SYSTEM_PROMPT = (
     "Ты - ассистент для консультации по разным вопросам, в частности - касающихся компании Неофлекс. "
-    "Используй приведённый ниже контекст, чтобы ответить на вопрос. Возможно, но не точно, ответ уже содержится в контексте. "
+    "Используй приведённый контекст, чтобы ответить на вопрос. Возможно, но не точно, ответ уже содержится в контексте. "
     "Если к ответу вообще никак не получается прийти, просто сообщи, что не знаешь ответа. "
     "Не используй табличное форматирование и особые Markdown-стилизации, используй обычное текстовое представление, это важно."
-    "Вопрос: {question} \n"
-    "Контекст: {context}"
 )
+GENERATE_PROMPT = (
+    "Контекст: {context}\n\n"
+    "Вопрос: {question}"
+)
+
+def current_turn_documents(messages: List[Any]):
+    """
+    Документы, найденные тулом при обработке текущего запроса: они хранятся
+    в поле artifact сообщений ToolMessage, просматриваются только сообщения
+    после последнего HumanMessage, т.е. относящиеся к текущему вопросу,
+    а не к истории диалога.
+
+    Выходные данные:
+        Список документов, либо None, если тул в текущем запросе не вызывался
+    """
+    docs = None
+    for msg in reversed(messages):
+        if type(msg) is HumanMessage:
+            break
+        if type(msg) is ToolMessage and msg.artifact is not None:
+            docs = list(msg.artifact) + (docs or [])
+    return docs
+
+def build_answer_prompt(state: MessagesState):
+    """
+    Сборка запроса к LLM: системное сообщение GENERATE_SYSTEM_PROMPT и
+    сообщение по шаблону GENERATE_PROMPT, в котором вопросом считается
+    первый с конца элемент цепочки типа HumanMessage, контекст собирается
+    из найденных тулом документов (см. context_builder.assemble_context)
+    с ограничением размера CONTEXT_TOKEN_BUDGET. Если документов в цепочке нет,
+    контекстом считается последний элемент цепочки (результат работы тула).
+
+    Входные данные:
+        state: MessagesState - цепочка обработки запроса
+
+    Выходные данные:
+        Список сообщений запроса к LLM
+    """
+    for msg in reversed(state["messages"]):
+        if type(msg) is HumanMessage:
+            break
+    question = msg.content
+    docs = current_turn_documents(state["messages"])
+    if docs is None:
+        context = state["messages"][-1].content
+    else:
+        context = assemble_context(docs, CONTEXT_TOKEN_BUDGET, CONTEXT_CHARS_PER_TOKEN, CONTEXT_DUPLICATE_THRESHOLD)
+    return [
+        SystemMessage(content=GENERATE_SYSTEM_PROMPT),
+        HumanMessage(content=GENERATE_PROMPT.format(question=question, context=context)),
+    ]
 
 def generate_answer(state: MessagesState):
     """
-    Функция генератии ответа LLM на запрос по шаблону выше (GENERATE_PROMPT)
+    Функция генератии ответа LLM на запрос по шаблонам выше (см. build_answer_prompt)
     с использованием последнего элемента цепочки state как контекста
     и первого с конца элемента цепочки, имеющего тип HumanMessage в качестве
     вопроса. ФУНКЦИЯ НЕ ДОЛЖНА ВЫЗЫВАТЬСЯ КАК ПЕРВЫЙ ЭЛЕМЕНТ ГРАФА, иначе
@@ -55,17 +329,24 @@ def generate_answer(state: MessagesState):
     Выходные данные:
         Словарь формата {"messages": [response]}, содержащая цепочку ответа на запрос
     """
-    for msg in reversed(state["messages"]):
-        if type(msg) is HumanMessage:
-            break
-    question = msg.content
-    context = state["messages"][-1].content
-    prompt = GENERATE_PROMPT.format(question=question, context=context)
-    logging.debug(f"generate_answer called with prompt={prompt}")
-    response = model_data.llm.invoke([{"role": "user", "content": prompt}])
+    prompt = build_answer_prompt(state)
+    response = model_data.llm.invoke(prompt)
+    log_prompt("generate_answer", prompt, response)
     return {"messages": [response]}
 
-def create_graph(retriever_tool : Any):
+async def agenerate_answer(state: MessagesState):
+    """
+    Асинхронный вариант generate_answer, используется
+    при обработке запроса через graph.ainvoke.
+
+    Входные данные и выходные данные совпадают с generate_answer
+    """
+    prompt = build_answer_prompt(state)
+    response = await model_data.llm.ainvoke(prompt)
+    log_prompt("generate_answer", prompt, response)
+    return {"messages": [response]}
+
+def create_graph(retriever_tool : Any, checkpointer : Any = None):
     """
     Создание графа обработки запроса через LLM.
 
@@ -73,6 +354,9 @@ def create_graph(retriever_tool : Any):
     START (начальный узел)
     |
     |
+    trim_history (сжатие слишком длинной истории диалога)
+    |
+    |
     generate_query_or_respond
     |                 |
     |                 | 
@@ -91,7 +375,10 @@ def create_graph(retriever_tool : Any):
     END
 
     Входные данные:
-        Нет. Параметры задаются в model_data.set_parameters
+        retriever_tool - тул для поиска по векторной БД
+        checkpointer - хранилище истории диалогов, см. session_storage.create_checkpointer.
+            Если не задано, используется InMemorySaver.
+        Остальные параметры задаются в model_data.set_parameters
     
     Выходные данные:
         Граф обработки запроса пользователя
@@ -100,12 +387,23 @@ def create_graph(retriever_tool : Any):
     workflow = StateGraph(MessagesState)
     retriever_tool_state = retriever_tool
 
-    # Define the nodes we will cycle between
-    workflow.add_node(generate_query_or_respond)
+    workflow.add_node("trim_history", RunnableLambda(trim_history, afunc=atrim_history))
+
+    # Define the nodes we will cycle between.
+    # Each node has a sync and an async implementation, so that the graph
+    # works both through graph.invoke and through graph.ainvoke
+    workflow.add_node(
+        "generate_query_or_respond",
+        RunnableLambda(generate_query_or_respond, afunc=agenerate_query_or_respond),
+    )
     workflow.add_node("retrieve", ToolNode([retriever_tool_state]))
-    workflow.add_node(generate_answer)
+    workflow.add_node(
+        "generate_answer",
+        RunnableLambda(generate_answer, afunc=agenerate_answer),
+    )
 
-    workflow.add_edge(START, "generate_query_or_respond")
+    workflow.add_edge(START, "trim_history")
+    workflow.add_edge("trim_history", "generate_query_or_respond")
     workflow.add_conditional_edges(
         "generate_query_or_respond",
         # Assess LLM decision (call `retriever_tool` tool or respond to the user)
@@ -120,5 +418,6 @@ def create_graph(retriever_tool : Any):
     workflow.add_edge("retrieve", "generate_answer")
     workflow.add_edge("generate_answer", END)
 
-    checkpointer = InMemorySaver()
+    if checkpointer is None:
+        checkpointer = InMemorySaver()
     return workflow.compile(checkpointer=checkpointer)
\ No newline at end of file
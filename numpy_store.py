@@ -0,0 +1,212 @@
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+def numpy_index_path(db_path: str, collection_name: str):
+    """
+    Папка NumPy-копии коллекции - рядом с файлами векторной БД
+    """
+    return os.path.join(db_path, f"{collection_name}_numpy")
+
+def export_numpy_index(vector_store, path: str, page_size: int = 10000):
+    """
+    Выгрузка коллекции Chroma в папку path: матрица эмбеддингов float32
+    (vectors.npy) и JSON-файлы с ID, текстами и метаданными фрагментов.
+    Коллекция читается постранично, матрица пишется на диск по мере чтения.
+    Новая копия сначала пишется во временную папку, которая затем заменяет старую.
+
+    Входные данные:
+        vector_store - коллекция Chroma
+        path - папка для сохранения
+
+    Выходные данные:
+        Число выгруженных фрагментов
+    """
+    total = vector_store._collection.count()
+    metric = (vector_store._collection.metadata or {}).get("hnsw:space", "l2")
+
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    ids, documents, metadatas = [], [], []
+    vectors = None
+    offset = 0
+    while offset < total:
+        page = vector_store.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        page_vectors = np.asarray(page["embeddings"], dtype=np.float32)
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(
+                os.path.join(tmp_path, "vectors.npy"), mode="w+", dtype=np.float32,
+                shape=(total, page_vectors.shape[1]),
+            )
+        vectors[offset:offset + len(page_vectors)] = page_vectors
+        ids += page["ids"]
+        documents += page["documents"]
+        metadatas += [m or {} for m in page["metadatas"]]
+        offset += len(page["ids"])
+    if vectors is None:
+        np.save(os.path.join(tmp_path, "vectors.npy"), np.zeros((0, 0), dtype=np.float32))
+    else:
+        vectors.flush()
+        del vectors
+
+    with open(os.path.join(tmp_path, "ids.json"), 'w', encoding='utf-8') as file:
+        json.dump(ids, file)
+    with open(os.path.join(tmp_path, "documents.json"), 'w', encoding='utf-8') as file:
+        json.dump(documents, file, ensure_ascii=False)
+    with open(os.path.join(tmp_path, "metadatas.json"), 'w', encoding='utf-8') as file:
+        json.dump(metadatas, file, ensure_ascii=False)
+    with open(os.path.join(tmp_path, "meta.json"), 'w', encoding='utf-8') as file:
+        json.dump({"metric": metric, "count": len(ids)}, file)
+
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return len(ids)
+
+class NumpyVectorStore:
+    """
+    Векторная БД в памяти процесса поверх выгрузки export_numpy_index:
+    матрица эмбеддингов отображается в память (mmap), поиск k ближайших
+    фрагментов - одно матричное умножение. Поддерживает ту часть интерфейса
+    Chroma, которая используется приложением (similarity_search, get),
+    включая фильтры по метаданным ($eq, $ne, $in, $nin, $and, $or).
+    Порядок результатов соответствует метрике исходной коллекции (l2, cosine, ip).
+    """
+    def __init__(self, path: str, embeddings: Embeddings):
+        self.embeddings = embeddings
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        with open(os.path.join(path, "ids.json"), 'r', encoding='utf-8') as file:
+            self.ids = json.load(file)
+        with open(os.path.join(path, "documents.json"), 'r', encoding='utf-8') as file:
+            self.documents = json.load(file)
+        with open(os.path.join(path, "metadatas.json"), 'r', encoding='utf-8') as file:
+            self.metadatas = json.load(file)
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as file:
+            self.metric = json.load(file)["metric"]
+        self.positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        norms = np.linalg.norm(self.vectors, axis=1) if len(self.ids) else np.zeros(0, dtype=np.float32)
+        self.norms = norms.astype(np.float32)
+        # Значения каждого поля метаданных кодируются числами, чтобы фильтры вычислялись над массивами
+        self.codes = {}
+        self.vocabularies = {}
+        for key in {key for m in self.metadatas for key in m}:
+            vocabulary = {}
+            codes = np.array(
+                [vocabulary.setdefault(m[key], len(vocabulary)) if key in m else -1 for m in self.metadatas],
+                dtype=np.int32,
+            )
+            self.codes[key] = codes
+            self.vocabularies[key] = vocabulary
+
+    def __len__(self):
+        return len(self.ids)
+
+    def field_mask(self, key: str, condition: Any):
+        codes = self.codes.get(key)
+        if codes is None:
+            codes = np.full(len(self.ids), -1, dtype=np.int32)
+        vocabulary = self.vocabularies.get(key, {})
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        mask = np.ones(len(self.ids), dtype=bool)
+        for op, value in condition.items():
+            if op in ("$eq", "$ne"):
+                match = codes == vocabulary.get(value, -2)
+            elif op in ("$in", "$nin"):
+                match = np.isin(codes, [vocabulary[v] for v in value if v in vocabulary])
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+            mask &= ~match if op in ("$ne", "$nin") else match
+        return mask
+
+    def filter_mask(self, where: Dict[str, Any]):
+        """
+        Маска фрагментов, удовлетворяющих фильтру в формате Chroma
+        """
+        mask = np.ones(len(self.ids), dtype=bool)
+        for key, condition in where.items():
+            if key == "$and":
+                for sub in condition:
+                    mask &= self.filter_mask(sub)
+            elif key == "$or":
+                any_mask = np.zeros(len(self.ids), dtype=bool)
+                for sub in condition:
+                    any_mask |= self.filter_mask(sub)
+                mask &= any_mask
+            else:
+                mask &= self.field_mask(key, condition)
+        return mask
+
+    def make_document(self, i: int):
+        return Document(page_content=self.documents[i], metadata=dict(self.metadatas[i]), id=self.ids[i])
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                    filter: Optional[Dict[str, Any]] = None, **kwargs) -> List[Document]:
+        if not self.ids:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        # С фильтром оцениваются только подходящие под него фрагменты
+        rows = np.flatnonzero(self.filter_mask(filter)) if filter else None
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        norms = self.norms if rows is None else self.norms[rows]
+        scores = vectors @ query
+        if self.metric == "cosine":
+            scores = scores / np.where(norms > 0, norms, 1.0)
+        elif self.metric == "l2":
+            # Порядок по возрастанию |x - q|^2 = |x|^2 - 2 x.q + |q|^2
+            scores = 2 * scores - norms ** 2
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        if rows is not None:
+            top = rows[top]
+        return [self.make_document(int(i)) for i in top]
+
+    def nearest_embedding(self, embedding: List[float]):
+        """
+        Эмбеддинг ближайшего к embedding фрагмента, либо None, если фрагментов нет
+        """
+        nearest = self.similarity_search_by_vector(embedding, k=1)
+        return self.vectors[self.positions[nearest[0].id]] if nearest else None
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                          **kwargs) -> List[Document]:
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k, filter, **kwargs)
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None,
+            limit: Optional[int] = None, offset: Optional[int] = None,
+            include: List[str] = ("documents", "metadatas")):
+        """
+        Получение фрагментов по ID и/или фильтру, в том же формате, что и Chroma.get
+        """
+        if ids is None:
+            positions = list(range(len(self.ids)))
+        else:
+            positions = [self.positions[doc_id] for doc_id in ids if doc_id in self.positions]
+        if where:
+            mask = self.filter_mask(where)
+            positions = [i for i in positions if mask[i]]
+        positions = positions[offset or 0:]
+        if limit is not None:
+            positions = positions[:limit]
+        return {
+            "ids": [self.ids[i] for i in positions],
+            "documents": [self.documents[i] for i in positions] if "documents" in include else None,
+            "metadatas": [self.metadatas[i] for i in positions] if "metadatas" in include else None,
+            "embeddings": np.asarray(self.vectors[positions]) if "embeddings" in include else None,
+        }
+
+    def get_by_ids(self, ids: List[str]) -> List[Document]:
+        return [self.make_document(self.positions[doc_id]) for doc_id in ids if doc_id in self.positions]
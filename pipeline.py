@@ -1,9 +1,96 @@
+import asyncio
 import uuid
-from typing import Any
+from typing import Any, List
 from api_models import StringRequest
+from config import MAX_CONCURRENT_REQUESTS, REQUEST_TIMEOUT, BATCH_MAX_CONCURRENCY
 from state import model_data
+from model import GRAPH_NODES, current_turn_documents
+from dedup import split_sources
+from metrics import GraphMetricsHandler, GRAPH_RUNS_IN_FLIGHT, GRAPH_RUNS_WAITING
+from contextlib import asynccontextmanager
 from langchain_core.runnables import RunnableConfig
-from langchain_core.messages import ToolMessage
+from langchain_core.messages import AIMessage, HumanMessage
+
+# Ограничитель числа запросов, одновременно обрабатываемых графом в асинхронном режиме
+request_limiter = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Сбор времени работы узлов графа и числа токенов LLM, см. metrics.py
+graph_metrics_handler = GraphMetricsHandler(GRAPH_NODES)
+
+@asynccontextmanager
+async def limited_graph_run():
+    """
+    Ожидание свободного места в request_limiter с учётом числа ожидающих
+    и выполняющихся запусков графа в метриках
+    """
+    GRAPH_RUNS_WAITING.inc()
+    try:
+        await request_limiter.acquire()
+    finally:
+        GRAPH_RUNS_WAITING.dec()
+    GRAPH_RUNS_IN_FLIGHT.inc()
+    try:
+        yield
+    finally:
+        GRAPH_RUNS_IN_FLIGHT.dec()
+        request_limiter.release()
+
+def make_graph_input(msg: str):
+    """
+    Формирование входных данных графа из сообщения пользователя
+
+    Входные данные:
+        msg - сообщение пользователя
+
+    Выходные данные:
+        Словарь с цепочкой из одного сообщения пользователя
+    """
+    return {
+        "messages": [
+            {
+                "role": "user",
+                "content": msg,
+            }
+        ]
+    }
+
+def make_config(session_id: uuid.UUID):
+    """
+    Формирование конфигурации запуска графа для сеанса session_id
+    """
+    config: RunnableConfig = {
+        "configurable": {"thread_id": model_data.session_storage[session_id]},
+        "callbacks": [graph_metrics_handler],
+    }
+    return config
+
+async def amake_config(session_id: uuid.UUID):
+    """
+    Асинхронный вариант make_config: обращение к хранилищу сеансов, включая
+    удаление истории вытесненных сеансов из чекпоинтера, выполняется
+    в отдельном потоке и не блокирует event loop
+    """
+    return await asyncio.to_thread(make_config, session_id)
+
+def is_context_free(session_id: uuid.UUID):
+    """
+    Проверка, что в сеансе ещё нет истории диалога, т.е. ответ на
+    очередной вопрос не зависит от контекста и может быть взят из кэша ответов
+    """
+    return not model_data.graph.get_state(make_config(session_id)).values.get("messages")
+
+async def ais_context_free(session_id: uuid.UUID):
+    """
+    Асинхронный вариант is_context_free
+    """
+    return not (await model_data.graph.aget_state(await amake_config(session_id))).values.get("messages")
+
+def make_cached_turn(msg: str, answer: str):
+    """
+    Сообщения, которыми ответ из кэша записывается в историю диалога,
+    чтобы следующие вопросы пользователя обрабатывались с учётом этого ответа
+    """
+    return {"messages": [HumanMessage(content=msg), AIMessage(content=answer)]}
 
 def dispatch_message(msg: str, session_id: uuid):
     """
@@ -13,7 +100,7 @@ def dispatch_message(msg: str, session_id: uuid):
     Входные данные:
         msg - сообщение для обработки
         session_id - ID сессии с пользователем
-    
+
     Выходные данные:
         Цепочка обработки сообщения пользователя моделью,
         по шагам - тексты каждого запроса в процессе рассуждения модели,
@@ -23,18 +110,65 @@ def dispatch_message(msg: str, session_id: uuid):
         Нет.
     """
     try:
-        config: RunnableConfig = {"configurable": {"thread_id": model_data.session_storage[session_id]}}
-        return model_data.graph.invoke({
-            "messages": [
-                {
-                    "role": "user",
-                    "content": msg,
-                }
-            ]
-        }, config)['messages'][1:]
+        config = make_config(session_id)
+        return model_data.graph.invoke(make_graph_input(msg), config)['messages'][1:]
     except Exception as e:
         print(f'Error in dispatch_message: {e}')
 
+async def adispatch_message(msg: str, session_id: uuid):
+    """
+    Асинхронный вариант dispatch_message: прогоняет сообщение через
+    LLM-граф при помощи graph.ainvoke, не блокируя event loop.
+    Число одновременно обрабатываемых запросов ограничено
+    MAX_CONCURRENT_REQUESTS, время обработки - REQUEST_TIMEOUT
+    (время ожидания в очереди ограничителя не учитывается).
+
+    Входные данные и выходные данные совпадают с dispatch_message
+
+    Исключения:
+        asyncio.TimeoutError - обработка запроса не уложилась в REQUEST_TIMEOUT
+    """
+    try:
+        config = await amake_config(session_id)
+        async with limited_graph_run():
+            result = await asyncio.wait_for(
+                model_data.graph.ainvoke(make_graph_input(msg), config),
+                timeout=REQUEST_TIMEOUT,
+            )
+        return result['messages'][1:]
+    except asyncio.TimeoutError:
+        print(f'Timeout in adispatch_message for session {session_id}')
+        raise
+    except Exception as e:
+        print(f'Error in adispatch_message: {e}')
+
+def collect_source_documents(resp : Any, snippet_len : int = 30):
+    """
+    Сбор источников, найденных тулом при обработке текущего запроса.
+    Найденные документы хранятся в поле artifact сообщений ToolMessage,
+    просматриваются только сообщения после последнего HumanMessage,
+    т.е. относящиеся к текущему вопросу, а не к истории диалога.
+    В sources перечисляются все страницы, на которых встречается текст
+    фрагмента: при создании БД его почти точные копии с других страниц
+    отбрасываются, а их адреса сохраняются в поле метаданных "sources".
+
+    Входные данные:
+        resp - результат обработки запроса
+        snippet_len - максимальная длина фрагмента текста документа
+
+    Выходные данные:
+        List[{"source": str, "snippet": str, "sources": List[str]}]
+    """
+    docs = current_turn_documents(resp) or []
+    return [
+        {
+            "source": d.metadata["source"],
+            "snippet": d.page_content[:snippet_len] + ("..." if len(d.page_content) > snippet_len else ""),
+            "sources": split_sources(d.metadata.get("sources")) or [d.metadata["source"]],
+        }
+        for d in docs
+    ]
+
 def pack_answer_from_response(resp : Any, session_id : uuid.UUID):
     """
     Сохранение результатов обработки запроса в словарь для дальнейшей
@@ -43,43 +177,344 @@ def pack_answer_from_response(resp : Any, session_id : uuid.UUID):
     Входные данные:
         resp - результат обработки запроса
         session_id - ID сеанса с пользователем
-    
+
     Выходные данные:
         Словарь формата:
             answer: str
-            source_documents: List[{"source": str, "snippet": str}]
+            source_documents: List[{"source": str, "snippet": str, "sources": List[str]}]
             session_id: str
     """
-    if not any(type(x) is ToolMessage for x in resp):
-        model_data.top_doc_metadata = []
     return {
         "answer" : resp[-1].content,
-        "source_documents" : model_data.top_doc_metadata,
+        "source_documents" : collect_source_documents(resp),
         "session_id" : str(session_id)
     }
 
 def process_request_fully(req: StringRequest):
     """
     Функция обработки строки-запроса и получения
-    словаря с заполненными для формирования строки-ответа полями
+    словаря с заполненными для формирования строки-ответа полями.
+    Если задан кэш ответов (model_data.answer_cache) и вопрос задан
+    первым в сеансе, ответ на похожий вопрос берётся из кэша без запуска графа.
 
     Входные данные:
         req: StringRequest - строка-запрос, содержащая
                 сам вопрос, а также ID сеанса с пользователем
-    
+
     Выходные данные:
         Совпадают с pack_answer_from_response, т.е.
         Словарь формата:
             answer: str
-            source_documents: List[{"source": str, "snippet": str}]
+            source_documents: List[{"source": str, "snippet": str, "sources": List[str]}]
             session_id: str
-    
+
     Исключения:
         Нет.
     """
     try:
         msg = req.question
         session_id = uuid.UUID(req.session_id)
-        return pack_answer_from_response(dispatch_message(msg, session_id), session_id)
+        answer_cache = model_data.answer_cache
+        context_free = answer_cache is not None and is_context_free(session_id)
+        if context_free:
+            cached = answer_cache.lookup(msg)
+            if cached is not None:
+                model_data.graph.update_state(make_config(session_id), make_cached_turn(msg, cached["answer"]), as_node="generate_answer")
+                return {**cached, "session_id": str(session_id)}
+        result = pack_answer_from_response(dispatch_message(msg, session_id), session_id)
+        if context_free:
+            answer_cache.store(msg, result["answer"], result["source_documents"])
+        return result
     except Exception as e:
         print(f"Error in process_request_fully: {e}")
+
+async def aprocess_request_fully(req: StringRequest):
+    """
+    Асинхронный вариант process_request_fully, см. adispatch_message
+
+    Входные данные и выходные данные совпадают с process_request_fully
+
+    Исключения:
+        asyncio.TimeoutError - обработка запроса не уложилась в REQUEST_TIMEOUT
+    """
+    try:
+        msg = req.question
+        session_id = uuid.UUID(req.session_id)
+        answer_cache = model_data.answer_cache
+        context_free = answer_cache is not None and await ais_context_free(session_id)
+        if context_free:
+            cached = await answer_cache.alookup(msg)
+            if cached is not None:
+                await model_data.graph.aupdate_state(await amake_config(session_id), make_cached_turn(msg, cached["answer"]), as_node="generate_answer")
+                return {**cached, "session_id": str(session_id)}
+        result = pack_answer_from_response(await adispatch_message(msg, session_id), session_id)
+        if context_free:
+            await answer_cache.astore(msg, result["answer"], result["source_documents"])
+        return result
+    except asyncio.TimeoutError:
+        raise
+    except Exception as e:
+        print(f"Error in aprocess_request_fully: {e}")
+
+def group_batch_rounds(session_ids: List[uuid.UUID]):
+    """
+    Разбиение пакета вопросов на раунды: в каждом раунде не больше одного
+    вопроса каждого сеанса, вопросы одного сеанса попадают в раунды в порядке
+    их следования в пакете, чтобы каждый следующий обрабатывался с учётом
+    ответа на предыдущий
+
+    Входные данные:
+        session_ids - ID сеансов вопросов пакета, None для некорректных вопросов
+
+    Выходные данные:
+        Список раундов - списков номеров вопросов в пакете
+    """
+    rounds = []
+    counts = {}
+    for i, session_id in enumerate(session_ids):
+        if session_id is None:
+            continue
+        n = counts.get(session_id, 0)
+        counts[session_id] = n + 1
+        if n == len(rounds):
+            rounds.append([])
+        rounds[n].append(i)
+    return rounds
+
+def parse_batch_sessions(reqs: List[StringRequest], results: List[Any]):
+    """
+    Разбор ID сеансов вопросов пакета; для вопросов с некорректным ID
+    в results сразу записывается ошибка
+    """
+    session_ids = []
+    for i, req in enumerate(reqs):
+        try:
+            session_ids.append(uuid.UUID(req.session_id))
+        except Exception as e:
+            print(f"Error in batch item {i}: {e}")
+            session_ids.append(None)
+            results[i] = {"error": "Некорректный ID сеанса", "session_id": req.session_id}
+    return session_ids
+
+def batch_config(session_id: uuid.UUID, max_concurrency: int):
+    config = make_config(session_id)
+    config["max_concurrency"] = max_concurrency
+    return config
+
+def process_batch(reqs: List[StringRequest], max_concurrency: int = BATCH_MAX_CONCURRENCY):
+    """
+    Пакетная обработка вопросов: эмбеддинги всех вопросов считаются
+    одним вызовом модели, затем вопросы прогоняются через граф при помощи
+    graph.batch не более чем по max_concurrency одновременно. Вопросы одного
+    сеанса обрабатываются последовательно (см. group_batch_rounds), ответы
+    на первые вопросы сеансов, как и в process_request_fully, берутся из кэша
+    ответов. Ошибка обработки одного вопроса не прерывает обработку остальных.
+
+    Входные данные:
+        reqs - список строк-запросов
+        max_concurrency - максимальное число одновременных запусков графа
+
+    Выходные данные:
+        Список результатов в порядке reqs: словарь формата pack_answer_from_response,
+        либо при ошибке - {"error": str, "session_id": str}
+
+    Исключения:
+        Нет.
+    """
+    results = [None] * len(reqs)
+    session_ids = parse_batch_sessions(reqs, results)
+    answer_cache = model_data.answer_cache
+    if model_data.embeddings is not None:
+        try:
+            model_data.embeddings.embed_queries([req.question for req, s in zip(reqs, session_ids) if s is not None])
+        except Exception as e:
+            print(f"Error in process_batch embeddings: {e}")
+    for batch_round in group_batch_rounds(session_ids):
+        pending, context_free = [], {}
+        for i in batch_round:
+            msg, session_id = reqs[i].question, session_ids[i]
+            try:
+                context_free[i] = answer_cache is not None and is_context_free(session_id)
+                cached = answer_cache.lookup(msg) if context_free[i] else None
+                if cached is None:
+                    pending.append(i)
+                    continue
+                model_data.graph.update_state(make_config(session_id), make_cached_turn(msg, cached["answer"]), as_node="generate_answer")
+                results[i] = {**cached, "session_id": str(session_id)}
+            except Exception as e:
+                print(f"Error in process_batch: {e}")
+                results[i] = {"error": "Ошибка при обработке запроса", "session_id": str(session_id)}
+        if not pending:
+            continue
+        outputs = model_data.graph.batch(
+            [make_graph_input(reqs[i].question) for i in pending],
+            [batch_config(session_ids[i], max_concurrency) for i in pending],
+            return_exceptions=True,
+        )
+        for i, output in zip(pending, outputs):
+            session_id = session_ids[i]
+            try:
+                if isinstance(output, Exception):
+                    raise output
+                results[i] = pack_answer_from_response(output['messages'][1:], session_id)
+                if context_free[i]:
+                    answer_cache.store(reqs[i].question, results[i]["answer"], results[i]["source_documents"])
+            except Exception as e:
+                print(f"Error in process_batch: {e}")
+                results[i] = {"error": "Ошибка при обработке запроса", "session_id": str(session_id)}
+    return results
+
+async def aprocess_batch(reqs: List[StringRequest], max_concurrency: int = BATCH_MAX_CONCURRENCY):
+    """
+    Асинхронный вариант process_batch, вопросы прогоняются через граф
+    при помощи graph.ainvoke. Каждый запуск графа занимает место в общем
+    ограничителе MAX_CONCURRENT_REQUESTS наравне с одиночными запросами,
+    а внутри пакета одновременно выполняется не более max_concurrency запусков.
+    Время обработки каждого вопроса ограничено REQUEST_TIMEOUT.
+
+    Входные данные и выходные данные совпадают с process_batch
+
+    Исключения:
+        Нет.
+    """
+    results = [None] * len(reqs)
+    session_ids = parse_batch_sessions(reqs, results)
+    answer_cache = model_data.answer_cache
+    if model_data.embeddings is not None:
+        try:
+            await model_data.embeddings.aembed_queries([req.question for req, s in zip(reqs, session_ids) if s is not None])
+        except Exception as e:
+            print(f"Error in aprocess_batch embeddings: {e}")
+
+    async def answer_from_cache(i):
+        msg, session_id = reqs[i].question, session_ids[i]
+        context_free = answer_cache is not None and await ais_context_free(session_id)
+        cached = await answer_cache.alookup(msg) if context_free else None
+        if cached is not None:
+            await model_data.graph.aupdate_state(await amake_config(session_id), make_cached_turn(msg, cached["answer"]), as_node="generate_answer")
+            results[i] = {**cached, "session_id": str(session_id)}
+        return context_free
+
+    batch_limiter = asyncio.Semaphore(max_concurrency)
+
+    async def run_graph(i):
+        config = await amake_config(session_ids[i])
+        async with batch_limiter, limited_graph_run():
+            return await asyncio.wait_for(
+                model_data.graph.ainvoke(make_graph_input(reqs[i].question), config),
+                timeout=REQUEST_TIMEOUT,
+            )
+
+    for batch_round in group_batch_rounds(session_ids):
+        checks = await asyncio.gather(*[answer_from_cache(i) for i in batch_round], return_exceptions=True)
+        pending, context_free = [], {}
+        for i, check in zip(batch_round, checks):
+            if isinstance(check, Exception):
+                print(f"Error in aprocess_batch: {check}")
+                results[i] = {"error": "Ошибка при обработке запроса", "session_id": str(session_ids[i])}
+            elif results[i] is None:
+                pending.append(i)
+                context_free[i] = check
+        if not pending:
+            continue
+        outputs = await asyncio.gather(*[run_graph(i) for i in pending], return_exceptions=True)
+        for i, output in zip(pending, outputs):
+            session_id = session_ids[i]
+            try:
+                if isinstance(output, Exception):
+                    raise output
+                results[i] = pack_answer_from_response(output['messages'][1:], session_id)
+                if context_free[i]:
+                    await answer_cache.astore(reqs[i].question, results[i]["answer"], results[i]["source_documents"])
+            except Exception as e:
+                print(f"Error in aprocess_batch: {e}")
+                results[i] = {"error": "Ошибка при обработке запроса", "session_id": str(session_id)}
+    return results
+
+# Узлы графа, токены ответа LLM в которых передаются пользователю при потоковой обработке
+STREAMED_NODES = ("generate_query_or_respond", "generate_answer")
+# Узлы, текст которых передаётся только после их завершения: LLM может начать ответ
+# текстом, а затем в том же сообщении вызвать тул, и тогда этот текст не является ответом
+BUFFERED_NODES = ("generate_query_or_respond",)
+
+async def astream_request(req: StringRequest):
+    """
+    Потоковая обработка строки-запроса: токены ответа LLM передаются
+    по мере генерации (graph.astream в режиме "messages"), после
+    завершения работы графа передаётся полный ответ с источниками.
+    Текст узлов BUFFERED_NODES передаётся одним фрагментом после завершения
+    узла и только если он не вызвал тул.
+    Ограничения числа одновременных запросов и времени обработки
+    совпадают с adispatch_message.
+
+    Входные данные:
+        req: StringRequest - строка-запрос, содержащая
+                сам вопрос, а также ID сеанса с пользователем
+
+    Выходные данные:
+        Асинхронный генератор событий-словарей:
+            {"type": "token", "content": str} - очередной фрагмент ответа
+            {"type": "done", "answer": str, "source_documents": List[...], "session_id": str} -
+                полный ответ, формат совпадает с pack_answer_from_response
+            {"type": "error", "detail": str} - ошибка обработки, последнее событие
+    """
+    try:
+        msg = req.question
+        session_id = uuid.UUID(req.session_id)
+        answer_cache = model_data.answer_cache
+        context_free = answer_cache is not None and await ais_context_free(session_id)
+        if context_free:
+            cached = await answer_cache.alookup(msg)
+            if cached is not None:
+                await model_data.graph.aupdate_state(await amake_config(session_id), make_cached_turn(msg, cached["answer"]), as_node="generate_answer")
+                yield {"type": "done", **cached, "session_id": str(session_id)}
+                return
+        config = await amake_config(session_id)
+        final_state = None
+        async with limited_graph_run():
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + REQUEST_TIMEOUT
+            stream = model_data.graph.astream(make_graph_input(msg), config, stream_mode=["messages", "updates", "values"])
+            buffered = []
+            try:
+                while True:
+                    try:
+                        mode, chunk = await asyncio.wait_for(stream.__anext__(), deadline - loop.time())
+                    except StopAsyncIteration:
+                        break
+                    if mode == "values":
+                        final_state = chunk
+                        continue
+                    if mode == "updates":
+                        for node, update in chunk.items():
+                            if node not in BUFFERED_NODES:
+                                continue
+                            messages = (update or {}).get("messages", [])
+                            if buffered and not any(getattr(m, "tool_calls", None) for m in messages):
+                                yield {"type": "token", "content": "".join(buffered)}
+                            buffered = []
+                        continue
+                    message, metadata = chunk
+                    node = metadata.get("langgraph_node")
+                    if (
+                        isinstance(message, AIMessage)
+                        and node in STREAMED_NODES
+                        and isinstance(message.content, str)
+                        and message.content
+                    ):
+                        if node in BUFFERED_NODES:
+                            buffered.append(message.content)
+                        else:
+                            yield {"type": "token", "content": message.content}
+            finally:
+                await stream.aclose()
+        result = pack_answer_from_response(final_state['messages'][1:], session_id)
+        if context_free:
+            await answer_cache.astore(msg, result["answer"], result["source_documents"])
+        yield {"type": "done", **result}
+    except asyncio.TimeoutError:
+        print(f'Timeout in astream_request for session {req.session_id}')
+        yield {"type": "error", "detail": "Превышено время обработки запроса"}
+    except Exception as e:
+        print(f"Error in astream_request: {e}")
+        yield {"type": "error", "detail": "Ошибка при обработке запроса"}
@@ -0,0 +1,113 @@
+from typing import Callable, List, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from caches import LRUCache
+
+class EmbeddingReranker:
+    """
+    Переранжирование найденных фрагментов по косинусной близости эмбеддинга
+    запроса к эмбеддингам фрагментов, сохранённым в векторной БД. Эмбеддинги
+    фрагментов не пересчитываются: они читаются из БД одним запросом на все
+    отсутствующие в кэше фрагменты, а оценки всех кандидатов считаются одним
+    матричным умножением. Кэш эмбеддингов фрагментов сбрасывается при смене
+    версии коллекции (version_getter).
+    """
+    def __init__(self, embeddings: Embeddings, vector_db, cache_size: int = 10000,
+                 version_getter: Optional[Callable[[], str]] = None):
+        self.embeddings = embeddings
+        self.vector_db = vector_db
+        self.chunk_vectors = LRUCache(cache_size, version_getter=version_getter)
+
+    def get_chunk_vectors(self, ids: List[str]):
+        vectors = {}
+        missing = []
+        for doc_id, vector in zip(ids, self.chunk_vectors.get_many(ids)):
+            if vector is None:
+                missing.append(doc_id)
+            else:
+                vectors[doc_id] = vector
+        if missing:
+            found = self.vector_db.get(ids=missing, include=["embeddings"])
+            for doc_id, vector in zip(found["ids"], found["embeddings"]):
+                vector = np.asarray(vector, dtype=np.float32)
+                vector /= np.linalg.norm(vector) or 1.0
+                self.chunk_vectors.put(doc_id, vector)
+                vectors[doc_id] = vector
+        return vectors
+
+    def rerank(self, query: str, documents: List[Document], top_k: int) -> List[Document]:
+        """
+        Отбор top_k наиболее близких к запросу фрагментов
+
+        Входные данные:
+            query - строка запроса
+            documents - найденные фрагменты (с заполненным Document.id)
+            top_k - число возвращаемых фрагментов
+
+        Выходные данные:
+            Список фрагментов по убыванию близости к запросу
+        """
+        if len(documents) <= 1:
+            return documents[:top_k]
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+        vectors = self.get_chunk_vectors([doc.id for doc in documents])
+        # Фрагменты без сохранённого эмбеддинга получают минимальную оценку
+        scored = [doc for doc in documents if doc.id in vectors]
+        rest = [doc for doc in documents if doc.id not in vectors]
+        scores = np.stack([vectors[doc.id] for doc in scored]) @ query_vector if scored else np.zeros(0)
+        order = np.argsort(-scores, kind="stable")
+        return ([scored[i] for i in order] + rest)[:top_k]
+
+class CrossEncoderReranker:
+    """
+    Переранжирование найденных фрагментов небольшой моделью cross-encoder
+    на CPU: пары (запрос, текст фрагмента) оцениваются одним батчем.
+    Требует установленного пакета sentence-transformers.
+    """
+    def __init__(self, model_name: str, batch_size: int = 32):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError(
+                "Для переранжирования моделью cross-encoder необходимо установить пакет sentence-transformers"
+            ) from e
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.batch_size = batch_size
+
+    def rerank(self, query: str, documents: List[Document], top_k: int) -> List[Document]:
+        """
+        Отбор top_k фрагментов с наибольшей оценкой модели, см. EmbeddingReranker.rerank
+        """
+        if len(documents) <= 1:
+            return documents[:top_k]
+        scores = self.model.predict(
+            [(query, doc.page_content) for doc in documents], batch_size=self.batch_size,
+        )
+        order = np.argsort(-np.asarray(scores), kind="stable")
+        return [documents[i] for i in order[:top_k]]
+
+def create_reranker(backend: str, embeddings: Embeddings, vector_db, cross_encoder_model: str,
+                    version_getter: Optional[Callable[[], str]] = None):
+    """
+    Создание переранжировщика найденных фрагментов
+
+    Входные данные:
+        backend - "embeddings" (EmbeddingReranker) или "cross-encoder" (CrossEncoderReranker)
+        embeddings - эмбеддинги запросов (те же, что использованы при создании БД)
+        vector_db - векторная БД
+        cross_encoder_model - имя модели для "cross-encoder"
+        version_getter - функция получения версии коллекции для сброса кэша
+
+    Выходные данные:
+        Объект с методом rerank(query, documents, top_k)
+
+    Исключения:
+        ValueError - неизвестный backend
+    """
+    if backend == "embeddings":
+        return EmbeddingReranker(embeddings, vector_db, version_getter=version_getter)
+    if backend == "cross-encoder":
+        return CrossEncoderReranker(cross_encoder_model)
+    raise ValueError(f"Unknown rerank backend: {backend}")
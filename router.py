@@ -0,0 +1,121 @@
+import asyncio
+import threading
+from typing import Iterable, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Маршруты вопроса, см. QueryRouter.decide
+ROUTE_RETRIEVE = "retrieve"
+ROUTE_RESPOND = "respond"
+
+# Примеры вопросов, не требующих поиска по базе
+SMALL_TALK_EXAMPLES = (
+    "Привет",
+    "Здравствуйте",
+    "Добрый день",
+    "Как дела?",
+    "Спасибо",
+    "Спасибо за ответ",
+    "Пока",
+    "До свидания",
+    "Кто ты?",
+    "Что ты умеешь?",
+    "Hello",
+    "Thank you",
+)
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+class QueryRouter:
+    """
+    Быстрая маршрутизация вопроса без обращения к LLM:
+    - вопрос с ключевым словом (keywords) или с эмбеддингом, близким к ближайшему
+      фрагменту коллекции (не меньше retrieve_threshold), сразу отправляется на поиск;
+    - вопрос, близкий к примерам светской беседы (не меньше respond_threshold)
+      и далёкий от коллекции, получает ответ без поиска;
+    - в остальных случаях решение остаётся за LLM.
+    Близость - косинусная, эмбеддинг вопроса тот же, что используется при поиске,
+    поэтому при кэшировании эмбеддингов запросов повторно он не считается.
+    """
+    def __init__(self, embeddings: Embeddings, vector_db, keywords: Iterable[str],
+                 retrieve_threshold: float, respond_threshold: float,
+                 small_talk: Iterable[str] = SMALL_TALK_EXAMPLES):
+        self.embeddings = embeddings
+        self.vector_db = vector_db
+        self.keywords = tuple(k.lower() for k in keywords)
+        self.retrieve_threshold = retrieve_threshold
+        self.respond_threshold = respond_threshold
+        self.small_talk = list(small_talk)
+        self.small_talk_vectors = None
+        self.lock = threading.Lock()
+
+    def get_small_talk_vectors(self):
+        with self.lock:
+            if self.small_talk_vectors is None:
+                self.small_talk_vectors = normalize(self.embeddings.embed_documents(self.small_talk))
+            return self.small_talk_vectors
+
+    def nearest_embedding(self, vector: List[float]):
+        """
+        Эмбеддинг ближайшего к вопросу фрагмента коллекции, найденный одним запросом к БД
+
+        Выходные данные:
+            Эмбеддинг фрагмента или None, если коллекция пуста
+        """
+        collection = getattr(self.vector_db, "_collection", None)
+        if collection is None:
+            # NumpyVectorStore: эмбеддинги фрагментов уже в памяти процесса
+            return self.vector_db.nearest_embedding(vector)
+        found = collection.query(query_embeddings=[vector], n_results=1, include=["embeddings"])
+        embeddings = found["embeddings"][0] if found["embeddings"] is not None else []
+        return embeddings[0] if len(embeddings) else None
+
+    def collection_similarity(self, vector: List[float]):
+        """
+        Косинусная близость эмбеддинга вопроса к ближайшему фрагменту коллекции
+        """
+        nearest = self.nearest_embedding(vector)
+        if nearest is None:
+            return 0.0
+        return float(normalize(nearest) @ normalize(vector))
+
+    def decide(self, vector: List[float], doc_similarity: float):
+        if doc_similarity >= self.retrieve_threshold:
+            return ROUTE_RETRIEVE
+        small_talk_similarity = float(np.max(self.get_small_talk_vectors() @ normalize(vector)))
+        if small_talk_similarity >= self.respond_threshold and small_talk_similarity > doc_similarity:
+            return ROUTE_RESPOND
+        return None
+
+    def keyword_route(self, question: str):
+        text = question.lower()
+        return ROUTE_RETRIEVE if any(k in text for k in self.keywords) else None
+
+    def route(self, question: str) -> Optional[str]:
+        """
+        Выбор маршрута вопроса
+
+        Выходные данные:
+            ROUTE_RETRIEVE, ROUTE_RESPOND, либо None, если решение должна принять LLM
+        """
+        route = self.keyword_route(question)
+        if route is not None:
+            return route
+        vector = self.embeddings.embed_query(question)
+        return self.decide(vector, self.collection_similarity(vector))
+
+    async def aroute(self, question: str) -> Optional[str]:
+        """
+        Асинхронный вариант route
+        """
+        route = self.keyword_route(question)
+        if route is not None:
+            return route
+        vector = await self.embeddings.aembed_query(question)
+        doc_similarity = await asyncio.to_thread(self.collection_similarity, vector)
+        if self.small_talk_vectors is None:
+            await asyncio.to_thread(self.get_small_talk_vectors)
+        return self.decide(vector, doc_similarity)
@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import threading
+from typing import Callable, Iterable, List, Optional, Tuple
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+def section_index_path(db_path: str, collection_name: str):
+    """
+    Папка индекса разделов коллекции - рядом с файлами векторной БД
+    """
+    return os.path.join(db_path, f"{collection_name}_sections")
+
+def iter_section_vectors(vector_store, page_size: int = 10000):
+    """
+    Постраничное чтение разделов (поле метаданных "section") и эмбеддингов
+    всех фрагментов коллекции
+
+    Выходные данные:
+        Генератор пар (раздел, эмбеддинг фрагмента)
+    """
+    offset = 0
+    while True:
+        page = vector_store.get(include=["metadatas", "embeddings"], limit=page_size, offset=offset)
+        for metadata, vector in zip(page["metadatas"], page["embeddings"]):
+            section = (metadata or {}).get("section")
+            if section:
+                yield section, vector
+        if len(page["ids"]) < page_size:
+            return
+        offset += page_size
+
+def build_section_index(chunks: Iterable[Tuple[str, List[float]]], path: str):
+    """
+    Построение индекса разделов: эмбеддинг раздела - нормированное среднее
+    нормированных эмбеддингов его фрагментов. Индекс сначала пишется во временную
+    папку, которая затем заменяет старый индекс.
+
+    Входные данные:
+        chunks - поток пар (раздел фрагмента, эмбеддинг фрагмента)
+        path - папка для сохранения индекса
+
+    Выходные данные:
+        Число разделов
+    """
+    sums = {}
+    counts = {}
+    for section, vector in chunks:
+        vector = np.asarray(vector, dtype=np.float64)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        if section in sums:
+            sums[section] += vector
+        else:
+            sums[section] = vector.copy()
+        counts[section] = counts.get(section, 0) + 1
+
+    sections = list(sums)
+    if sections:
+        centroids = np.stack([sums[s] for s in sections])
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids = (centroids / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+    else:
+        centroids = np.zeros((0, 0), dtype=np.float32)
+
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "centroids.npy"), centroids)
+    with open(os.path.join(tmp_path, "sections.json"), 'w', encoding='utf-8') as file:
+        json.dump(sections, file, ensure_ascii=False)
+    with open(os.path.join(tmp_path, "meta.json"), 'w', encoding='utf-8') as file:
+        json.dump({"sections": len(sections), "chunks": sum(counts.values())}, file)
+
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return len(sections)
+
+class SectionIndex:
+    """
+    Индекс разделов, построенный build_section_index: первый этап двухэтапного
+    поиска, отбирающий разделы, фрагменты которых затем ищутся в векторной БД.
+    Если задан version_getter, индекс перечитывается с диска при смене
+    возвращаемой им версии данных (см. vector_store.get_collection_version),
+    т.е. после пересоздания БД при помощи db_creator.py.
+    """
+    def __init__(self, path: str, embeddings: Embeddings,
+                 version_getter: Optional[Callable[[], str]] = None):
+        self.path = path
+        self.embeddings = embeddings
+        self.version_getter = version_getter
+        self.version = version_getter() if version_getter is not None else None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        centroids = np.load(os.path.join(self.path, "centroids.npy"))
+        with open(os.path.join(self.path, "sections.json"), 'r', encoding='utf-8') as file:
+            sections = json.load(file)
+        with open(os.path.join(self.path, "meta.json"), 'r', encoding='utf-8') as file:
+            chunks = json.load(file)["chunks"]
+        self.centroids, self.sections, self.chunks = centroids, sections, chunks
+
+    def refresh(self):
+        """
+        Перечитывание индекса, если версия данных изменилась. Если прочитать
+        индекс не удалось, используется прежний, а попытка повторяется при
+        следующем вызове.
+        """
+        if self.version_getter is None:
+            return
+        version = self.version_getter()
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            try:
+                self.load()
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error in SectionIndex reload: {e}")
+                return
+            self.version = version
+
+    def __len__(self):
+        return len(self.sections)
+
+    def chunks_per_section(self):
+        return self.chunks / len(self.sections) if self.sections else 0.0
+
+    def search_by_vector(self, embedding: List[float], k: int) -> List[str]:
+        """
+        Поиск k разделов, ближайших к эмбеддингу запроса по косинусной близости
+
+        Выходные данные:
+            Список разделов по убыванию близости
+        """
+        # Поля читаются один раз: при перечитывании индекса они заменяются новыми
+        centroids, sections = self.centroids, self.sections
+        if not sections:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = centroids @ (query / (np.linalg.norm(query) or 1.0))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [sections[i] for i in top]
+
+    def search(self, query: str, k: int) -> List[str]:
+        return self.search_by_vector(self.embeddings.embed_query(query), k)
+
+def load_section_index(db_path: str, collection_name: str, embeddings: Embeddings,
+                       version_getter: Optional[Callable[[], str]] = None):
+    """
+    Загрузка индекса разделов коллекции, построенного db_creator.py
+
+    Входные данные:
+        db_path - путь к папке БД
+        collection_name - имя коллекции в БД
+        embeddings - эмбеддинги запросов, те же, что и у векторной БД
+        version_getter - версия данных коллекции, при её смене индекс перечитывается
+
+    Выходные данные:
+        SectionIndex, либо None, если индекс ещё не построен
+    """
+    path = section_index_path(db_path, collection_name)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    return SectionIndex(path, embeddings, version_getter)
@@ -1,12 +1,162 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
 class SessionStorage:
-    def __init__(self):
-        self.d = {}
+    """
+    Хранилище соответствий "ID сеанса пользователя -> thread_id графа" в памяти
+    процесса. Сеансы, к которым не обращались дольше ttl секунд, а также самые
+    давние сеансы сверх max_sessions удаляются. Для каждого удалённого сеанса
+    вызывается on_evict(thread_id), например, для удаления истории из чекпоинтера.
+    """
+    def __init__(self, max_sessions: Optional[int] = None, ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[Any], None]] = None):
+        self.d = OrderedDict()
         self.idx = 1
-    
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+
     def __getitem__(self, key):
-        if key not in self.d:
-            self.d[key] = self.idx
-            self.idx += 1
-            return self.idx - 1
-        else:
-            return self.d[key]
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            if self.ttl is not None:
+                while self.d:
+                    oldest_key, (thread_id, last_access) = next(iter(self.d.items()))
+                    if now - last_access <= self.ttl:
+                        break
+                    del self.d[oldest_key]
+                    evicted.append(thread_id)
+            if key in self.d:
+                thread_id, _ = self.d.pop(key)
+            else:
+                thread_id = self.idx
+                self.idx += 1
+            self.d[key] = (thread_id, now)
+            if self.max_sessions is not None:
+                while len(self.d) > self.max_sessions:
+                    _, (old_thread_id, _) = self.d.popitem(last=False)
+                    evicted.append(old_thread_id)
+        self._evict(evicted)
+        return thread_id
+
+    def __len__(self):
+        return len(self.d)
+
+    def _evict(self, thread_ids):
+        if self.on_evict is None:
+            return
+        for thread_id in thread_ids:
+            try:
+                self.on_evict(thread_id)
+            except Exception as e:
+                print(f"Error in SessionStorage eviction of thread {thread_id}: {e}")
+
+class SqliteSessionStorage(SessionStorage):
+    """
+    Хранилище сеансов в SQLite-файле. Правила удаления сеансов совпадают
+    с SessionStorage, но соответствия сохраняются между перезапусками
+    и общие для всех процессов (uvicorn-воркеров), использующих один файл.
+    """
+    def __init__(self, db_path: str, max_sessions: Optional[int] = None, ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[Any], None]] = None):
+        super().__init__(max_sessions, ttl, on_evict)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "thread_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "session_id TEXT UNIQUE NOT NULL, "
+            "last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)")
+
+    def __getitem__(self, key):
+        key = str(key)
+        now = time.time()
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                evicted = []
+                if self.ttl is not None:
+                    evicted += [row[0] for row in cur.execute(
+                        "DELETE FROM sessions WHERE last_access < ? RETURNING thread_id",
+                        (now - self.ttl,),
+                    )]
+                cur.execute(
+                    "INSERT INTO sessions (session_id, last_access) VALUES (?, ?) "
+                    "ON CONFLICT (session_id) DO UPDATE SET last_access = excluded.last_access",
+                    (key, now),
+                )
+                thread_id = cur.execute("SELECT thread_id FROM sessions WHERE session_id = ?", (key,)).fetchone()[0]
+                if self.max_sessions is not None:
+                    evicted += [row[0] for row in cur.execute(
+                        "DELETE FROM sessions WHERE thread_id IN ("
+                        "SELECT thread_id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?) "
+                        "RETURNING thread_id",
+                        (self.max_sessions,),
+                    )]
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        self._evict(evicted)
+        return thread_id
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+def create_session_storage(backend: str, db_path: str = "", max_sessions: Optional[int] = None,
+                           ttl: Optional[float] = None, on_evict: Optional[Callable[[Any], None]] = None):
+    """
+    Создание хранилища сеансов
+
+    Входные данные:
+        backend - "memory" (в памяти процесса) или "sqlite" (в файле db_path)
+        db_path - путь к SQLite-файлу, используется при backend == "sqlite"
+        max_sessions - максимальное число хранимых сеансов, None - без ограничения
+        ttl - время жизни неиспользуемого сеанса в секундах, None - без ограничения
+        on_evict - функция, вызываемая с thread_id каждого удалённого сеанса
+
+    Выходные данные:
+        SessionStorage или SqliteSessionStorage
+
+    Исключения:
+        ValueError - неизвестный backend
+    """
+    if backend == "memory":
+        return SessionStorage(max_sessions, ttl, on_evict)
+    if backend == "sqlite":
+        return SqliteSessionStorage(db_path, max_sessions, ttl, on_evict)
+    raise ValueError(f"Unknown session backend: {backend}")
+
+def create_checkpointer(backend: str, db_path: str = ""):
+    """
+    Создание хранилища состояний (истории диалогов) графа
+
+    Входные данные:
+        backend - "memory" (в памяти процесса) или "sqlite" (SQLite-файл db_path,
+            может совпадать с файлом хранилища сеансов). В обоих случаях хранится
+            только последний чекпоинт каждого диалога
+        db_path - путь к SQLite-файлу, используется при backend == "sqlite"
+
+    Выходные данные:
+        Чекпоинтер для передачи в create_graph
+
+    Исключения:
+        ValueError - неизвестный backend
+    """
+    if backend == "memory":
+        from memory_saver import LatestInMemorySaver
+        return LatestInMemorySaver()
+    if backend == "sqlite":
+        from sqlite_saver import ThreadedSqliteSaver
+        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return ThreadedSqliteSaver(conn)
+    raise ValueError(f"Unknown session backend: {backend}")
@@ -1,3 +1,6 @@
+import threading
+import time
+
 class ModelData:
     _instance = None
     _initialized = False
@@ -11,19 +14,82 @@ class ModelData:
         if not self._initialized:
             self.llm = None
             self.retriever_tool = None
-            self.top_doc_metadata = []
+            self.answer_cache = None
+            self.lexical_index = None
+            self.reranker = None
+            self.router = None
+            self.embeddings = None
+            self.section_index = None
+            self.factories = {}
+            self.init_times = {}
+            self.init_errors = {}
+            self.init_lock = threading.RLock()
             self._initialized = True
 
-    def set_parameters(self, llm, retriever_tool, vector_db, session_storage, graph):
+    def set_parameters(self, llm, retriever_tool, vector_db, session_storage, graph, answer_cache=None,
+                       lexical_index=None, reranker=None, router=None, embeddings=None, section_index=None):
         """
         Установка параметров графа - используемая LLM
         и тул для получения наиболее близких по смыслу
-        текстов из БД
+        текстов из БД, а также необязательные кэш ответов
+        (caches.SemanticAnswerCache), лексический индекс
+        для гибридного поиска (lexical_index.LexicalIndex),
+        переранжировщик найденных фрагментов (см. reranker.create_reranker),
+        маршрутизатор вопросов (router.QueryRouter), эмбеддинги
+        запросов (caches.CachedEmbeddings) для пакетной обработки
+        и индекс разделов для двухэтапного поиска (section_index.SectionIndex)
         """
         self.llm = llm
         self.retriever_tool = retriever_tool
         self.vector_db = vector_db
         self.session_storage = session_storage
         self.graph = graph
+        self.answer_cache = answer_cache
+        self.lexical_index = lexical_index
+        self.reranker = reranker
+        self.router = router
+        self.embeddings = embeddings
+        self.section_index = section_index
+
+    def set_lazy(self, **factories):
+        """
+        Регистрация параметров, создаваемых при первом обращении к ним:
+        для каждого имени параметра передаётся функция без аргументов,
+        создающая его значение. Заменяет значения, заданные set_parameters.
+        """
+        for name, factory in factories.items():
+            self.__dict__.pop(name, None)
+            self.factories[name] = factory
+
+    def __getattr__(self, name):
+        # Вызывается только для отсутствующих атрибутов, т.е. ещё не созданных ленивых параметров
+        factories = self.__dict__.get("factories")
+        if not factories or name not in factories:
+            raise AttributeError(name)
+        with self.init_lock:
+            if name not in self.__dict__:
+                start = time.perf_counter()
+                try:
+                    value = factories[name]()
+                except Exception as e:
+                    self.init_errors[name] = repr(e)
+                    raise
+                self.init_times[name] = time.perf_counter() - start
+                self.init_errors.pop(name, None)
+                self.__dict__[name] = value
+            return self.__dict__[name]
+
+    def pending(self):
+        """
+        Имена ещё не созданных ленивых параметров
+        """
+        return [name for name in self.factories if name not in self.__dict__]
+
+    def initialize(self):
+        """
+        Создание всех ещё не созданных ленивых параметров
+        """
+        for name in self.pending():
+            getattr(self, name)
 
 model_data = ModelData()
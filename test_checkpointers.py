@@ -0,0 +1,66 @@
+import asyncio
+import sqlite3
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.graph import MessagesState, StateGraph, START, END
+from memory_saver import LatestInMemorySaver
+from session_storage import create_checkpointer
+
+TURNS = 20
+
+def answer(state: MessagesState):
+    return {"messages": [AIMessage(content=f"ответ {len(state['messages'])}")]}
+
+def make_graph(checkpointer):
+    workflow = StateGraph(MessagesState)
+    workflow.add_node("answer", answer)
+    workflow.add_edge(START, "answer")
+    workflow.add_edge("answer", END)
+    return workflow.compile(checkpointer=checkpointer)
+
+def run_turns(graph, thread_id, turns=TURNS):
+    config = {"configurable": {"thread_id": thread_id}}
+    for i in range(turns):
+        graph.invoke({"messages": [HumanMessage(content=f"вопрос {i}")]}, config)
+    return graph.get_state(config).values["messages"]
+
+def thread_size(checkpointer, thread_id):
+    return (
+        len(checkpointer.storage[thread_id][""]),
+        sum(k[0] == thread_id for k in checkpointer.writes),
+        sum(k[0] == thread_id for k in checkpointer.blobs),
+    )
+
+def test_memory_saver_keeps_latest_checkpoint():
+    checkpointer = LatestInMemorySaver()
+    graph = make_graph(checkpointer)
+    assert len(run_turns(graph, "short", 2)) == 4
+    assert len(run_turns(graph, "long")) == 2 * TURNS
+    # Объём хранимого не зависит от числа ходов диалога
+    assert thread_size(checkpointer, "long") == thread_size(checkpointer, "short")
+    assert thread_size(checkpointer, "long")[0] == 1
+    checkpointer.delete_thread("long")
+    assert "long" not in checkpointer.storage
+    assert not any(k[0] == "long" for k in checkpointer.writes)
+    assert not any(k[0] == "long" for k in checkpointer.blobs)
+    assert thread_size(checkpointer, "short")[0] == 1
+
+def test_memory_saver_async():
+    graph = make_graph(LatestInMemorySaver())
+    config = {"configurable": {"thread_id": "1"}}
+
+    async def run():
+        for i in range(TURNS):
+            await graph.ainvoke({"messages": [HumanMessage(content=f"вопрос {i}")]}, config)
+        return (await graph.aget_state(config)).values["messages"]
+
+    assert len(asyncio.run(run())) == 2 * TURNS
+    assert len(graph.checkpointer.storage["1"][""]) == 1
+
+def test_sqlite_saver_keeps_latest_checkpoint(tmp_path):
+    db_path = str(tmp_path / "sessions.sqlite")
+    graph = make_graph(create_checkpointer("sqlite", db_path))
+    assert len(run_turns(graph, "1")) == 2 * TURNS
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM checkpoints WHERE thread_id = '1'").fetchone()[0] == 1
+    writes = conn.execute("SELECT COUNT(DISTINCT checkpoint_id) FROM writes WHERE thread_id = '1'").fetchone()[0]
+    assert writes <= 1
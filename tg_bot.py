@@ -1,16 +1,168 @@
 import os
+import time
 import uuid
 import json
-import requests
+import asyncio
+import sqlite3
+import threading
+from collections import deque
+import httpx
 from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
 
 # Configuration
 BOT_TOKEN = os.getenv('NF_HW_BOT_TOKEN')  # Set your bot token as environment variable
 API_URL = "http://localhost:8000/process-string"  # Replace with your actual API URL
+STREAM_API_URL = "http://localhost:8000/process-string-stream"  # Streaming (SSE) version of API_URL
+USE_STREAMING = os.getenv('NF_HW_BOT_STREAMING', '1') != '0'  # Show the answer while it is being generated
+EDIT_INTERVAL = 1.0  # Minimal interval between edits of the streamed reply, in seconds (Telegram rate limits edits)
+MAX_CONCURRENCY = int(os.getenv('NF_HW_BOT_MAX_CONCURRENCY', '32'))  # Max updates handled (workers) and API requests sent at once
+MAX_PENDING_PER_CHAT = int(os.getenv('NF_HW_BOT_MAX_PENDING_PER_CHAT', '3'))  # Max unanswered updates per chat, the rest are rejected
+UPDATE_QUEUE_SIZE = int(os.getenv('NF_HW_BOT_UPDATE_QUEUE_SIZE', '1000'))  # Max updates accepted but not yet handled
+API_TIMEOUT = 600  # Timeout of one API request, in seconds
+SESSION_DB_PATH = os.getenv('NF_HW_BOT_SESSION_DB', './bot_sessions.sqlite')  # User -> session store shared by bot processes
+TELEGRAM_BASE_URL = os.getenv('NF_HW_BOT_TELEGRAM_URL')  # Bot API server URL, e.g. a local fake server for tests (default: api.telegram.org)
+# Webhook mode: if WEBHOOK_URL is set, Telegram sends updates to WEBHOOK_URL + WEBHOOK_PATH instead of being polled
+WEBHOOK_URL = os.getenv('NF_HW_BOT_WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('NF_HW_BOT_WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('NF_HW_BOT_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('NF_HW_BOT_WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('NF_HW_BOT_WEBHOOK_SECRET')  # Checked against the X-Telegram-Bot-Api-Secret-Token header
 
-# Store user sessions in memory (in production, use a database)
-user_sessions = {}
+# Shared HTTP client with a keep-alive connection pool to the API, created in post_init
+http_client: httpx.AsyncClient = None
+# Limits the number of API requests sent at once
+api_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+class SessionStore:
+    """
+    User -> session ID mapping in a SQLite file, so several bot processes can share it.
+    The async methods run the queries in a worker thread: waiting for another
+    process's write lock must not stall the event loop.
+    """
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS user_sessions (user_id INTEGER PRIMARY KEY, session_id TEXT NOT NULL)")
+        self.lock = threading.Lock()
+
+    def get_or_create(self, user_id: int, session_id: str):
+        """Return the user's session ID, storing session_id if the user has none yet"""
+        with self.lock:
+            # A single insert decides the winner when several processes race for the same user
+            self.conn.execute(
+                "INSERT INTO user_sessions (user_id, session_id) VALUES (?, ?) ON CONFLICT (user_id) DO NOTHING",
+                (user_id, session_id),
+            )
+            return self.conn.execute("SELECT session_id FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def set(self, user_id: int, session_id: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO user_sessions (user_id, session_id) VALUES (?, ?)", (user_id, session_id))
+
+    async def aget_or_create(self, user_id: int, session_id: str):
+        return await asyncio.to_thread(self.get_or_create, user_id, session_id)
+
+    async def aset(self, user_id: int, session_id: str):
+        await asyncio.to_thread(self.set, user_id, session_id)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles updates with a fixed number of workers, one update of a chat at a time
+    and in the order they arrived. Chats with pending updates take turns, so a busy
+    chat does not hold up the others. At most queue_size updates are accepted
+    at once; updates beyond max_pending_per_chat in one chat are passed to on_overflow.
+    """
+    def __init__(self, workers: int, queue_size: int, max_pending_per_chat: int, on_overflow=None):
+        super().__init__(queue_size)
+        self.workers = workers
+        self.max_pending_per_chat = max_pending_per_chat
+        self.on_overflow = on_overflow
+        self.chats = {}  # chat ID -> deque of (coroutine, future) not handled yet
+        self.ready = None  # IDs of chats with pending updates, waiting for a worker
+        self.tasks = []
+
+    def is_full(self):
+        """Whether new updates would have to wait for a free place in the queue"""
+        return self.current_concurrent_updates >= self.max_concurrent_updates
+
+    async def initialize(self):
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for pending in self.chats.values():
+            for coroutine, future in pending:
+                coroutine.close()
+                future.cancel()
+        self.chats.clear()
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        pending = self.chats.get(chat.id)
+        if pending is not None and len(pending) >= self.max_pending_per_chat:
+            coroutine.close()
+            if self.on_overflow is not None:
+                await self.on_overflow(update)
+            return
+        future = asyncio.get_running_loop().create_future()
+        if pending is None:
+            self.chats[chat.id] = deque([(coroutine, future)])
+            self.ready.put_nowait(chat.id)
+        else:
+            pending.append((coroutine, future))
+        await future
+
+    async def worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            pending = self.chats[chat_id]
+            coroutine, future = pending[0]
+            try:
+                await coroutine
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(None)
+            finally:
+                pending.popleft()
+                # The chat gets its next turn after the chats that are already waiting
+                if pending:
+                    self.ready.put_nowait(chat_id)
+                else:
+                    del self.chats[chat_id]
+
+async def reject_update(update: Update):
+    """Tell the user that their previous messages have not been answered yet"""
+    if update.message is not None:
+        await update.message.reply_text("⏳ Предыдущий вопрос ещё обрабатывается, дождитесь ответа.")
+
+user_sessions = SessionStore(SESSION_DB_PATH)
+update_processor = ChatOrderedUpdateProcessor(MAX_CONCURRENCY, UPDATE_QUEUE_SIZE, MAX_PENDING_PER_CHAT, reject_update)
+
+async def post_init(application: Application):
+    """Create the shared HTTP client when the bot starts"""
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(API_TIMEOUT, connect=10),
+        limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY),
+        headers={'Content-Type': 'application/json'},
+    )
+
+async def post_shutdown(application: Application):
+    """Close the shared HTTP client when the bot stops"""
+    if http_client is not None:
+        await http_client.aclose()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /start command"""
@@ -26,7 +178,7 @@ async def create_new_session(user_id: int, update: Update, context: ContextTypes
     """Create a new session UUID for user and send welcome message"""
     # Generate new UUID for the session
     new_session_id = str(uuid.uuid4())
-    user_sessions[user_id] = new_session_id
+    await user_sessions.aset(user_id, new_session_id)
     
     # Create keyboard with options
     keyboard = [["/start", "/reset"]]
@@ -45,15 +197,86 @@ async def create_new_session(user_id: int, update: Update, context: ContextTypes
         parse_mode='Markdown'
     )
 
+def format_answer(answer: str, source_documents: list) -> str:
+    """Format the answer with the list of its sources"""
+    if not source_documents:
+        # If no source documents, just send the answer
+        return answer
+    # If there are source documents, append each source
+    response_text = answer + "\n\n**Источники:**\n"
+    for doc in source_documents:
+        source = doc.get("source", "[неизвестный источник]")
+        response_text += f"\n{source}"
+    return response_text
+
+async def edit_reply(reply, text: str, **kwargs):
+    """Edit a sent message; an edit that would not change it counts as done"""
+    try:
+        await reply.edit_text(text, **kwargs)
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+
+async def stream_answer(update: Update, request_data: dict):
+    """Send the question to the streaming endpoint and progressively edit the reply while tokens arrive"""
+    await update.message.chat.send_action(action="typing")
+
+    reply = None
+    text = ""
+    sent_text = ""
+    last_edit = 0.0
+    async with http_client.stream("POST", STREAM_API_URL, json=request_data) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            event = json.loads(line[len("data: "):])
+
+            if event["type"] == "token":
+                text += event["content"]
+                if time.monotonic() - last_edit < EDIT_INTERVAL or not text.strip():
+                    continue
+                # Intermediate text is sent without Markdown: it may contain unclosed markup
+                if reply is None:
+                    reply = await update.message.reply_text(text)
+                elif text != sent_text:
+                    try:
+                        await edit_reply(reply, text)
+                    except BadRequest:
+                        pass
+                sent_text = text
+                last_edit = time.monotonic()
+
+            elif event["type"] == "done":
+                print(f"Response received: {event}")
+                response_text = format_answer(event.get("answer", "[нет ответа]"), event.get("source_documents", []))
+                if reply is None:
+                    await update.message.reply_text(
+                        response_text,
+                        parse_mode='Markdown',
+                        reply_markup=ReplyKeyboardMarkup([["/start", "/reset"]], resize_keyboard=True)
+                    )
+                else:
+                    try:
+                        await edit_reply(reply, response_text, parse_mode='Markdown')
+                    except BadRequest:
+                        # Markdown could not be parsed: keep the plain text
+                        if response_text != sent_text:
+                            await edit_reply(reply, response_text)
+                return
+
+            elif event["type"] == "error":
+                await update.message.reply_text(f"❌ Сервер сообщает об ошибке: {event.get('detail', '')}")
+                return
+
+    await update.message.reply_text("❌ Сервер оборвал соединение, не прислав ответ.")
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages from users"""
     user_id = update.effective_user.id
     
     # Get or create session ID for user
-    session_id = user_sessions.get(user_id)
-    if not session_id:
-        session_id = str(uuid.uuid4())
-        user_sessions[user_id] = session_id
+    session_id = await user_sessions.aget_or_create(user_id, str(uuid.uuid4()))
     
     user_question = update.message.text
     
@@ -64,21 +287,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     
     try:
-        # Send typing action to show bot is working
-        await update.message.chat.send_action(action="typing")
-        
-        # Send HTTP request to the API
-        response = requests.post(
-            API_URL,
-            json=request_data,
-            headers={'Content-Type': 'application/json'},
-            timeout=600
-        )
-        response.raise_for_status()
-        
-        # Parse response
-        api_response = response.json()
-        
+        async with api_semaphore:
+            if USE_STREAMING:
+                await stream_answer(update, request_data)
+                return
+
+            # Send typing action to show bot is working
+            await update.message.chat.send_action(action="typing")
+
+            # Send HTTP request to the API
+            response = await http_client.post(API_URL, json=request_data)
+            response.raise_for_status()
+
+            # Parse response
+            api_response = response.json()
+
         print(f"Response received: {api_response}")
         
         # Extract answer and source documents
@@ -86,15 +309,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         source_documents = api_response.get("source_documents", [])
         
         # Format the response
-        if not source_documents:
-            # If no source documents, just send the answer
-            response_text = answer
-        else:
-            # If there are source documents, append each source
-            response_text = answer + "\n\n**Источники:**\n"
-            for doc in source_documents:
-                source = doc.get("source", "[неизвестный источник]")
-                response_text += f"\n{source}"
+        response_text = format_answer(answer, source_documents)
         
         # Send the response back to user
         await update.message.reply_text(
@@ -104,7 +319,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=ReplyKeyboardMarkup([["/start", "/reset"]], resize_keyboard=True)
         )
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = f"❌ Ошибка при обработке HTTP-запроса: {str(e)}"
         await update.message.reply_text(error_message)
     except json.JSONDecodeError:
@@ -132,10 +347,61 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=ReplyKeyboardMarkup([["/start", "/reset"]], resize_keyboard=True)
     )
 
+async def run_webhook(application: Application):
+    """Receive updates from Telegram with a webhook server instead of polling"""
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import Response
+    from starlette.routing import Route
+
+    async def telegram_webhook(request: Request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        # Telegram delivers the update again later, so nothing is lost while the queue is full
+        if update_processor.is_full():
+            return Response(status_code=503)
+        await application.update_queue.put(Update.de_json(await request.json(), application.bot))
+        return Response()
+
+    server = uvicorn.Server(uvicorn.Config(
+        Starlette(routes=[Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"])]),
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        log_level="warning",
+    ))
+    # post_init and post_shutdown are only called by run_polling/run_webhook, so they are called here
+    async with application:
+        await post_init(application)
+        try:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            await application.start()
+            await server.serve()
+            await application.stop()
+        finally:
+            await post_shutdown(application)
+
 def main():
     """Start the bot"""
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Updates of different chats are handled concurrently, so one slow answer does not block other chats
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL.rstrip('/')}/bot").base_file_url(f"{TELEGRAM_BASE_URL.rstrip('/')}/file/bot")
+    if WEBHOOK_URL:
+        # Updates come from our own webhook server, not from the built-in updater
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -145,7 +411,10 @@ def main():
     
     # Start the bot
     print("Bot is running...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
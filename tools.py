@@ -1,25 +1,110 @@
 from langchain_classic.tools.retriever import create_retriever_tool
-from langchain_community.tools import DuckDuckGoSearchResults
 from state import model_data
+from caches import LRUCache, make_retrieval_key
+from metrics import VECTOR_QUERY_DURATION, RERANK_DURATION
+from config import RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL, COLLECTION_NAME, HYBRID_CANDIDATES
+from config import RERANK_CANDIDATES, RERANK_TOP_K, SECTION_CANDIDATES, SECTION_MIN_CHUNKS
+from lexical_index import reciprocal_rank_fusion
+from vector_store import DEFAULT_DB_PATH, get_collection_version
+from functools import partial
 from langchain_core.tools import tool
-from typing import Any, Optional, Dict
+from langchain_core.documents import Document
+from typing import Any, Optional, Dict, List
 
-search = DuckDuckGoSearchResults()
+# Кэш результатов поиска по векторной БД: (запрос, k, фильтр) -> найденные документы.
+# Сбрасывается при пересоздании коллекции
+retrieval_cache = LRUCache(
+    RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL,
+    partial(get_collection_version, DEFAULT_DB_PATH, COLLECTION_NAME),
+)
+
+def hybrid_search(query: str, query_vector: List[float], k: int, filter: Optional[Dict[str, str]] = None,
+                  vector_filter: Optional[Dict[str, Any]] = None, **kwargs):
+    """
+    Гибридный поиск: по HYBRID_CANDIDATES лучших фрагментов из векторной БД
+    и из лексического (BM25) индекса объединяются методом reciprocal rank fusion,
+    возвращаются k лучших. Фрагменты, найденные только лексическим индексом,
+    читаются из векторной БД по ID с фильтром filter.
+
+    Входные данные:
+        query - строка запроса
+        query_vector - эмбеддинг запроса
+        k - число возвращаемых фрагментов
+        filter - фильтр по метаданным фрагментов
+        vector_filter - фильтр только для векторного поиска (по умолчанию filter),
+            например с условием на разделы, см. restrict_to_sections: точные
+            совпадения названий из лексического индекса им не отбрасываются
+
+    Выходные данные:
+        Список найденных документов
+    """
+    vector_db = model_data.vector_db
+    candidates = max(k, HYBRID_CANDIDATES)
+    if vector_filter is None:
+        vector_filter = filter
+    with VECTOR_QUERY_DURATION.time():
+        vector_docs = vector_db.similarity_search_by_vector(query_vector, candidates, vector_filter, **kwargs)
+    lexical_ids = [doc_id for doc_id, _ in model_data.lexical_index.search(query, candidates)]
+
+    docs = {doc.id: doc for doc in vector_docs}
+    missing = [doc_id for doc_id in lexical_ids if doc_id not in docs]
+    if missing:
+        found = vector_db.get(ids=missing, where=filter or None, include=["documents", "metadatas"])
+        for doc_id, text, metadata in zip(found["ids"], found["documents"], found["metadatas"]):
+            docs[doc_id] = Document(page_content=text, metadata=metadata or {}, id=doc_id)
+    # Отброшенные фильтром и удалённые из БД после построения индекса фрагменты не учитываются
+    lexical_ids = [doc_id for doc_id in lexical_ids if doc_id in docs]
+
+    fused = reciprocal_rank_fusion([[doc.id for doc in vector_docs], lexical_ids], k)
+    return [docs[doc_id] for doc_id in fused]
+
+def restrict_to_sections(query_vector: List[float], filter: Optional[Dict[str, Any]] = None):
+    """
+    Первый этап двухэтапного поиска: отбор SECTION_CANDIDATES разделов,
+    ближайших к запросу, по индексу разделов (model_data.section_index)
+    и добавление к фильтру условия на раздел фрагмента. Индекс перечитывается
+    при пересоздании БД; отбор не выполняется, если разделов мало или
+    в среднем на раздел приходится меньше SECTION_MIN_CHUNKS фрагментов.
+
+    Выходные данные:
+        Фильтр для поиска фрагментов
+    """
+    section_index = model_data.section_index
+    if section_index is None:
+        return filter
+    section_index.refresh()
+    if len(section_index) <= SECTION_CANDIDATES or section_index.chunks_per_section() < SECTION_MIN_CHUNKS:
+        return filter
+    section_filter = {"section": {"$in": section_index.search_by_vector(query_vector, SECTION_CANDIDATES)}}
+    return {"$and": [filter, section_filter]} if filter else section_filter
 
 @tool(description="Возвращает ближайшие по смыслу записи из базы")
-def retrieval_function(x: Any, k: int = 5, snippet_len: int = 30, filter: Optional[Dict[str, str]] = None, **kwargs):
-    retval = model_data.vector_db.similarity_search(x, k, filter, **kwargs)
-    model_data.top_doc_metadata = [
-        {
-            "source": d.metadata["source"],
-            "snippet": d.page_content[:snippet_len] + ("..." if len(d.page_content) > snippet_len else "")
-        }
-        for d in retval
-    ]
-    return retval
+def retrieval_function(x: Any, k: int = 5, filter: Optional[Dict[str, str]] = None, **kwargs):
+    key = make_retrieval_key(x, k, filter, **kwargs)
+    retval = retrieval_cache.get(key)
+    if retval is None:
+        reranker = model_data.reranker
+        # При переранжировании отбирается больше кандидатов, а возвращается меньше фрагментов
+        fetch_k = max(k, RERANK_CANDIDATES) if reranker is not None else k
+        # Эмбеддинг запроса считается отдельно, чтобы в VECTOR_QUERY_DURATION попадал только поиск в БД
+        query_vector = model_data.vector_db.embeddings.embed_query(x)
+        search_filter = restrict_to_sections(query_vector, filter)
+        if model_data.lexical_index is not None:
+            retval = hybrid_search(x, query_vector, fetch_k, filter, search_filter, **kwargs)
+        else:
+            with VECTOR_QUERY_DURATION.time():
+                retval = model_data.vector_db.similarity_search_by_vector(query_vector, fetch_k, search_filter, **kwargs)
+        if reranker is not None:
+            with RERANK_DURATION.time():
+                retval = reranker.rerank(x, retval, min(k, RERANK_TOP_K))
+        retrieval_cache.put(key, retval)
+    return list(retval)
 
+# Найденные документы возвращаются тулом как artifact в ToolMessage,
+# т.е. хранятся в состоянии графа конкретного запроса, а не в общем model_data
 retriever_tool = create_retriever_tool(
     retrieval_function,
     "retrieve_neoflex_info",
-    "Найти и вернуть информацию об организации 'Неофлекс'."
+    "Найти и вернуть информацию об организации 'Неофлекс'.",
+    response_format="content_and_artifact",
 )
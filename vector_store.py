@@ -1,6 +1,63 @@
-from langchain_chroma import Chroma
+import os
+import threading
+import uuid
+from numpy_store import NumpyVectorStore, numpy_index_path
 
-def load_vector_store(collection_name: str, embeddings):
+DEFAULT_DB_PATH = "./chroma_langchain_db"
+
+# Прочитанные версии коллекций: путь к файлу версии -> (отметка файла, версия)
+_collection_versions = {}
+_collection_versions_lock = threading.Lock()
+
+def collection_version_path(db_path: str, collection_name: str):
+    return os.path.join(db_path, f"{collection_name}.version")
+
+def get_collection_version(db_path: str, collection_name: str):
+    """
+    Получение версии коллекции - метки, меняющейся при каждом пересоздании
+    коллекции при помощи db_creator.py. Используется для сброса кэшей,
+    зависящих от содержимого БД.
+
+    Входные данные:
+        db_path - путь к папке БД
+        collection_name - имя коллекции в БД
+
+    Выходные данные:
+        Строка-версия, либо пустая строка, если версия ещё не записывалась
+    """
+    # Вызывается при каждом обращении к кэшам, поэтому файл перечитывается,
+    # только если изменились его время изменения, размер или inode
+    path = collection_version_path(db_path, collection_name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return ""
+    stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    with _collection_versions_lock:
+        cached = _collection_versions.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            version = file.read().strip()
+    except FileNotFoundError:
+        return ""
+    with _collection_versions_lock:
+        _collection_versions[path] = (stamp, version)
+    return version
+
+def bump_collection_version(db_path: str, collection_name: str):
+    """
+    Запись новой версии коллекции, см. get_collection_version
+
+    Входные данные:
+        db_path - путь к папке БД
+        collection_name - имя коллекции в БД
+    """
+    with open(collection_version_path(db_path, collection_name), 'w', encoding='utf-8') as file:
+        file.write(uuid.uuid4().hex)
+
+def load_vector_store(collection_name: str, embeddings, backend: str = "chroma"):
     """
     Загрузки векторной БД. Если она ещё не была создана,
     её необходимо создать при помощи db_creator.py
@@ -8,18 +65,39 @@ def load_vector_store(collection_name: str, embeddings):
     Входные данные:
         collection_name - имя коллекции в БД
         embeddings - использованные эмбеддинги при создании БД
+        backend - "chroma" - коллекция Chroma, "numpy" - её выгрузка
+            в NumPy-матрицу (numpy_store.NumpyVectorStore), создаваемая db_creator.py
 
     Выходные данные:
         Векторная БД
+
+    Исключения:
+        ValueError - БД пуста, не создана или задан неизвестный backend
     """
 
+    if backend == "numpy":
+        path = numpy_index_path(DEFAULT_DB_PATH, collection_name)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            print("NumPy-копия БД не найдена. Необходимо создать БД при помощи db_creator.py")
+            raise ValueError
+        vector_store = NumpyVectorStore(path, embeddings)
+        if len(vector_store) == 0:
+            print("База данных пуста. Необходимо создать БД при помощи db_creator.py")
+            raise ValueError
+        return vector_store
+    if backend != "chroma":
+        raise ValueError(f"Unknown vector store backend: {backend}")
+    # Импорт Chroma занимает заметное время, поэтому выполняется только при её использовании
+    from langchain_chroma import Chroma
+
     vector_store = Chroma(
         collection_name=collection_name,
         embedding_function=embeddings,
-        persist_directory="./chroma_langchain_db",  # Where to save data locally, remove if not necessary
+        persist_directory=DEFAULT_DB_PATH,  # Where to save data locally, remove if not necessary
     )
 
-    if len(vector_store.get()['ids']) == 0:
+    # Проверка без чтения ID и текстов всех фрагментов коллекции
+    if vector_store._collection.count() == 0:
         print("База данных пуста. Необходимо создать БД при помощи db_creator.py")
         raise ValueError
 